@@ -1,12 +1,15 @@
 import chess
 import chess.pgn
 import os
+import sys
 import json
+import hashlib
 import ujson
 import itertools
 import pprint
 
 from cli_util import error, warn, success, info, header, confirm
+from profiling import profiled
 from parse_pgn import parse_game
 from analyze_sample import build_stats_path
 
@@ -43,7 +46,9 @@ def get_main_line(opening):
     return OPENINGS[opening]["main"]
 
 def get_opening_color(opening):
-    opening_obj = OPENINGS[opening]
+    return get_entry_color(OPENINGS[opening])
+
+def get_entry_color(opening_obj):
     main_line = opening_obj["main_real"] if "main_real" in opening_obj else opening_obj["main"]
     moves = parse_game(main_line)
     return chess.BLACK if len(moves)%2 == 0 else chess.WHITE
@@ -148,6 +153,18 @@ def calc_attainability(opening, color):
     if opening not in OPENINGS:
         raise KeyError(error(f"Opening {opening} not found in json."))
 
+    tree_root = build_decision_tree(opening)
+    ret = calc_att_tree(tree_root, color, is_opposite_color)
+    if is_opposite_color:
+        return (ret, None)
+    else:
+        btl = generate_BTL(opening, tree_root, color, opening_color)
+        if btl == "*":
+            print(error(f"No BTL for {opening}"))
+        return (ret, btl)
+
+
+def build_decision_tree(opening):
     main_line = parse_game(get_main_line(opening))
     transpositions = OPENINGS[opening]["transpositions"]
     transpositions = [parse_game(line) for line in transpositions]
@@ -164,7 +181,11 @@ def calc_attainability(opening, color):
             if move not in cur_obj:
                 cur_obj[move] = {}
             cur_obj = cur_obj[move]
+    return tree_root
 
+
+def calc_att_tree(tree_root, color, is_opposite_color):
+    # Attainability over a decision tree. In att calc, marks each best try with "best_try"/"att".
     # Recurse down the tree.
     MOVE_STACK = []     # Used for debugging.
     def calc_att_inner(tree_obj, stats_obj, cur_color):
@@ -257,16 +278,7 @@ def calc_attainability(opening, color):
         return att_base
 
     # Root = Black, so that first move flips to White.
-    ret = calc_att_inner(tree_root, STATS, chess.BLACK)
-    if is_opposite_color:
-        return (ret, None)
-    else:
-        btl = generate_BTL(opening, tree_root, color, opening_color)
-        if btl == "*":
-            print(error(f"No BTL for {opening}"))
-        return (ret, btl)
-
-    return ret
+    return calc_att_inner(tree_root, STATS, chess.BLACK)
 
 
 def generate_BTL(opening, tree_root, color, opening_color):
@@ -465,22 +477,104 @@ def update_stats(opening):
     return
 
 
-def write_opening_stats():
-    confirmed = confirm(f"Update openings.json file?")
+def opening_lines_hash(opening):
+    # Everything update_stats_main()/update_stats() read from the entry itself.
+    opening_obj = OPENINGS[opening]
+    lines = [opening_obj.get("main"), opening_obj.get("main_real"), opening_obj.get("transpositions")]
+    return hashlib.sha1(json.dumps(lines).encode()).hexdigest()[:16]
+
+def stats_version(rating):
+    # Size + mtime of the stats file: changes whenever counting rewrites it.
+    stats_path = build_stats_path(rating)
+    if not os.path.exists(stats_path):
+        return None
+    st = os.stat(stats_path)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+def computed_key(opening, rating):
+    return {"lines": opening_lines_hash(opening), "stats": stats_version(rating)}
+
+def is_stale(opening, rating):
+    return OPENINGS[opening].get("computed", {}).get(str(rating)) != computed_key(opening, rating)
+
+
+def drop_intervals(opening, rating):
+    # Removes the "<stat>_ci" keys (bootstrap_stats.py) at rating. True if there were any.
+    dropped = False
+    for key in ["stats_main", "stats"]:
+        stats = OPENINGS[opening].get(key)
+        if not isinstance(stats, dict) or not isinstance(stats.get(str(rating)), dict):
+            continue
+        for label in [label for label in stats[str(rating)] if label.endswith(cfg["CI_SUFFIX"])]:
+            del stats[str(rating)][label]
+            dropped = True
+    return dropped
+
+def update_opening(opening):
+    # update_stats_main() + update_stats() at RATING, recording what they were computed from.
+    # Intervals from bootstrap_stats.py belong to the old values: resampled if there were any.
+    had_intervals = drop_intervals(opening, RATING)
+    update_stats_main(opening)
+    update_stats(opening)
+    if had_intervals:
+        import bootstrap_stats  # Imports this module: pass the entry, not just its name.
+        bootstrap_stats.update_opening_ci(opening, OPENINGS[opening], RATING, STATS)
+    OPENINGS[opening].setdefault("computed", {})[str(RATING)] = computed_key(opening, RATING)
+
+
+def update_stale_openings(ratings=cfg["RATINGS"], write=True):
+    # Recompute only openings whose lines changed since their last update at a rating,
+    #  or whose stats file was rewritten since. Returns the number of updates.
+    global RATING, STATS
+    prev_rating, prev_stats = RATING, STATS
+    num_updated = 0
+    try:
+        for rating in ratings:
+            if stats_version(rating) is None:
+                print(warn(f"No stats for {rating}. Skipping..."))
+                continue
+            stale = [opening for opening in OPENINGS if is_stale(opening, rating)]
+            if not stale:
+                continue
+            RATING = rating
+            STATS = get_stats()
+            for opening in stale:
+                update_opening(opening)
+            num_updated += len(stale)
+            if DEBUG_MODE:
+                print(info(f"[{rating}] Updated {len(stale)} of {len(OPENINGS)} openings: {', '.join(stale)}"))
+    finally:
+        RATING, STATS = prev_rating, prev_stats
+    if num_updated == 0:
+        print(success("All openings up to date."))
+    elif write:
+        write_opening_stats(ask=False)
+    return num_updated
+
+
+def write_opening_stats(ask=True):
+    confirmed = confirm(f"Update openings.json file?") if ask else True
     if confirmed:
         with open(OPENINGS_JSON, 'w') as openings_file:
             ujson.dump(OPENINGS, openings_file, indent=4)
         print(success(f"Wrote to {OPENINGS_JSON}."))
 
 
-def process_all_openings(func, root_obj=OPENINGS):
+@profiled
+def process_all_openings(func, root_obj=OPENINGS, write=True):
     # func should update the global OPENINGS dict.
     for opening in root_obj:
         func(opening)
-    write_opening_stats()
+    if write:
+        write_opening_stats()
 
 
 if __name__ == "__main__":
+    if "--stale" in sys.argv:
+        # After editing openings.json or recounting: only what changed.
+        update_stale_openings()
+        sys.exit()
+
     # Actual work:
     # process_all_openings(find_transpositions)
     # process_all_openings(update_stats_main)
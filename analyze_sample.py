@@ -1,10 +1,17 @@
 import os
+import sys
 import json
 import ujson
 import pprint
 
 import cli_util
+import metrics
+import checkpoint
+import clock_sidecar
+from profiling import profiled
+from prefetch_reader import open_pgn
 from parse_pgn import read_headers, parse_headers, read_game, parse_game
+from eco_groupby import HeaderGroups, build_groups_path
 
 ### CONFIG
 try:
@@ -19,10 +26,18 @@ EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
 STATS_DEPTH = cfg["STATS_DEPTH"]    # How many half-moves deep to go.
 LABELS = cfg["STAT_LABEL"]
 
+METRICS = metrics.NULL_METRICS
+
 
 def build_stats_path(rating, depth=cfg["STATS_DEPTH"]):
     return os.path.join(cfg["STATS_DIR"], f'{str(rating)}{cfg["DEPTH_SUFFIX"]}{depth}{cfg["JSON_EXT"]}')
 
+def use_stats_dir(stats_dir):
+    # Stats paths of this process point into stats_dir (benchmark stages, self-checks).
+    #  Returns the one analyze_opening loads at import (STATS_RATING's).
+    cfg["STATS_DIR"] = stats_dir
+    return build_stats_path(cfg["STATS_RATING"])
+
 def build_sample_path(rating):
     return os.path.join(cfg["PGN_DIR"], cfg["BY_ELO_DIR"], f"{rating}{cfg['PGN_EXT']}")
 
@@ -51,34 +66,85 @@ def get_result(headers):
 def has_valid_result(name, value):
     if name == cfg["PGN_HEADERS"]["RESULT"]:
         if value not in cfg["RESULTS"]:
-            if DEBUG_MODE:
+            METRICS.skip("invalid_result")
+            if EXTRA_DEBUG_MODE:
                 print(cli_util.info(f"Invalid result: {value}. Skipping game..."))
             return -1
         return 1
     return 0
 
 
-def get_counts_by_rating(rating):
-    sample_path = build_sample_path(rating)
+@profiled
+def get_counts_by_rating(rating, sample_path=None, resume=False, group_by=cfg["GROUP_BY"]["ENABLED"],
+        think_times=cfg["CLOCKS"]["ENABLED"]):
+    global METRICS
+    if sample_path is None:
+        sample_path = build_sample_path(rating)
     num_games = 0
-    num_games_expected = cfg["NUM_EXPECTED_GAMES"]["RATINGS"][str(rating)]
+    num_read = 0
+    num_games_expected = cfg["NUM_EXPECTED_GAMES"]["RATINGS"].get(str(rating))
 
     # Initialize counts dict.
     counts_dict = {}
     counts_dict["stats"] = init_stats_dict()
+    groups = HeaderGroups() if group_by else None
+
+    ckpt_path = checkpoint.build_checkpoint_path(f"{sample_path}{cfg['DEPTH_SUFFIX']}{STATS_DEPTH}")
+    state = checkpoint.load_checkpoint(ckpt_path, sample_path) if resume else None
+    clock_reader = None
+    if think_times:
+        clock_reader = clock_sidecar.open_clock_reader(sample_path, state.get("clk_offset") if state else None)
+    node_times = clock_sidecar.NodeTimes() if clock_reader is not None else None
+
+    with open_pgn(sample_path) as sample_file:
+        METRICS = metrics.start_metrics("get_counts_by_rating", sample_file, num_games_expected,
+            rating=rating, depth=STATS_DEPTH)
+        if state is not None:
+            sample_file.seek(state["in_offset"])
+            counts_dict = state["tree"]
+            if group_by and state.get("groups"):
+                groups = HeaderGroups.from_state(state["groups"])
+            if node_times is not None and state.get("think_times"):
+                node_times = clock_sidecar.NodeTimes.from_state(state["think_times"])
+            num_games, num_read = state["num_games"], state["num_read"]
+            METRICS.restore(state["metrics"])
+        next_ckpt = num_read + checkpoint.CHECKPOINT_EVERY
+        in_offset = None    # Of the next game, once known (for the clock sidecar).
 
-    with open(sample_path, 'r') as sample_file:
         while True:
+            if num_read >= next_ckpt:
+                checkpoint.save_checkpoint(ckpt_path, {
+                    "input": checkpoint.fingerprint(sample_path),
+                    "in_offset": sample_file.tell(),
+                    "num_games": num_games,
+                    "num_read": num_read,
+                    "metrics": METRICS.state(),
+                    "tree": counts_dict,
+                    "groups": groups.state() if groups is not None else None,
+                    "clk_offset": clock_reader.tell() if clock_reader is not None else None,
+                    "think_times": node_times.state() if node_times is not None else None,
+                })
+                next_ckpt += checkpoint.CHECKPOINT_EVERY
+
             try:
                 headers = read_headers(sample_file, cond=has_valid_result)
             except EOFError:
                 break
+            num_read += 1
+            METRICS.tick(num_read, num_games)
             if headers == "":   # Game was skipped (invalid result).
+                in_offset = None
                 continue
 
+            if clock_reader is not None and in_offset is None:
+                in_offset = clock_sidecar.header_offset(sample_file, headers)
+            raw_headers = headers
             headers = parse_headers(headers)
             result = get_result(headers)
-            game = parse_game(read_game(sample_file))
+            if groups is not None:
+                groups.add(headers, result)
+            movetext = read_game(sample_file)
+            game = parse_game(movetext)
             if len(game) > STATS_DEPTH:
                 game = game[:STATS_DEPTH]
 
@@ -90,12 +156,24 @@ def get_counts_by_rating(rating):
                 new_obj = cur_obj[move]
                 update_dict(new_obj, result)
                 cur_obj = new_obj
+            if node_times is not None:
+                clocks = clock_reader.get(in_offset)
+                time_control = clock_sidecar.parse_time_control(headers.get(cfg["PGN_HEADERS"]["TIME"], ""))
+                if clocks is None or not node_times.add_game(game, clocks, time_control):
+                    METRICS.skip("no_think_times")
+                in_offset = clock_sidecar.next_game_offset(in_offset, raw_headers, movetext)
             num_games += 1
 
+    checkpoint.clear_checkpoint(ckpt_path)
+    if groups is not None:
+        groups.write(build_groups_path(rating))
+    if node_times is not None:
+        clock_reader.close()
+        node_times.write(clock_sidecar.build_think_times_path(rating))
+    METRICS.finish(num_read, num_games)
     print(cli_util.success(f"{num_games} games processed."))
     return counts_dict
 
-
 def construct_move_dict(move, obj, parent):
     return {
         "move": move,
@@ -130,14 +208,17 @@ def read_stats(rating):
         root_obj = json.load(stats_file)
     return root_obj
 
-def write_stats(root_obj, rating):
-    stats_path = build_stats_path(rating)
+@profiled
+def write_stats(root_obj, rating, stats_path=None):
+    if stats_path is None:
+        stats_path = build_stats_path(rating)
     with open(stats_path, 'w') as stats_file:
         ujson.dump(root_obj, stats_file)
     print(cli_util.success(f"Wrote stats to {stats_path}."))
     return
 
 
+@profiled
 def normalize_counts(root_obj):
     for d in breadth_first_traverse_moves(root_obj):
         stats = d["obj"]["stats"]
@@ -157,6 +238,6 @@ def normalize_counts(root_obj):
 
 if __name__ == "__main__":
     rating = 1200
-    root_obj = get_counts_by_rating(rating)
+    root_obj = get_counts_by_rating(rating, resume="--resume" in sys.argv)
     root_obj = normalize_counts(root_obj)
     write_stats(root_obj, rating)
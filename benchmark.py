@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import traceback
+import contextlib
+import multiprocessing
+
+import ujson
+
+import cli_util
+from gen_pgn import build_synthetic_path, generate_pgn
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+BENCH_CFG = cfg["BENCHMARK"]
+
+'''
+Throughput benchmark for each pipeline stage, on a synthetic PGN (see gen_pgn.py).
+Each stage runs in a fresh process so peak RSS is per stage, and stdout is discarded
+ (the cost of printing is still measured). Stages chain through a temp directory.
+Dedup, GROUP_BY and CLOCKS are off whatever config.json says: their side outputs
+ (dedup filters, *_groups.json, *.clk, *_think_times.json) go to fixed paths, which
+ the benchmark would otherwise write into the real pgn/ and stats/.
+'''
+
+
+def run_sanitize(paths, rating):
+    from sanitize_pgn import sanitize_games
+    from prefetch_reader import open_pgn
+    start = time.perf_counter()
+    with open_pgn(paths["src"]) as pgn_file:
+        _, num_games = sanitize_games(pgn_file, out_path=paths["sanitized"],
+            remove_duplicates=False, group_by=False, keep_clocks=False)
+    return time.perf_counter() - start, num_games, os.path.getsize(paths["src"])
+
+def run_separate(paths, rating):
+    from sample_by_elo import separate_by_elo
+    start = time.perf_counter()
+    _, num_games = separate_by_elo(rating, pgn_path=paths["sanitized"], out_path=paths["by_elo"], keep_clocks=False)
+    return time.perf_counter() - start, num_games, os.path.getsize(paths["sanitized"])
+
+def run_counts(paths, rating):
+    from analyze_sample import get_counts_by_rating, normalize_counts, use_stats_dir, LABELS
+    start = time.perf_counter()
+    root_obj = normalize_counts(get_counts_by_rating(rating, sample_path=paths["by_elo"],
+        group_by=False, think_times=False))
+    elapsed = time.perf_counter() - start
+    with open(use_stats_dir(paths["stats_dir"]), 'w') as stats_file:
+        ujson.dump(root_obj, stats_file)   # Input for the next stage (not timed).
+    return elapsed, root_obj["stats"][LABELS["TOTAL"]], os.path.getsize(paths["by_elo"])
+
+def run_openings(paths, rating):
+    from analyze_sample import use_stats_dir
+    use_stats_dir(paths["stats_dir"])
+    import analyze_opening  # Loads the counts stage's stats.
+    start = time.perf_counter()
+    analyze_opening.process_all_openings(analyze_opening.update_stats, write=False)
+    return time.perf_counter() - start, len(analyze_opening.OPENINGS), 0
+
+# (name, function, unit of items)
+STAGES = [
+    ("sanitize_games", run_sanitize, "games"),
+    ("separate_by_elo", run_separate, "games"),
+    ("get_counts_by_rating", run_counts, "games"),
+    ("process_all_openings", run_openings, "openings"),
+]
+
+
+def stage_worker(conn, func, paths, rating):
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            elapsed, num_items, num_bytes = func(paths, rating)
+    except Exception:
+        conn.send({"error": traceback.format_exc()})
+        return
+    # ru_maxrss is in KB on Linux, bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1 << 20) if sys.platform == "darwin" else peak_rss / (1 << 10)
+    conn.send({
+        "seconds": round(elapsed, 3),
+        "items": num_items,
+        "items_per_s": round(num_items / elapsed, 1),
+        "mb_per_s": round(num_bytes / (1 << 20) / elapsed, 2),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    })
+
+
+def run_benchmark(num_games, rating=BENCH_CFG["RATING"]):
+    src_path = build_synthetic_path(num_games)
+    if not os.path.exists(src_path):
+        generate_pgn(num_games, src_path)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {
+            "src": src_path,
+            "sanitized": os.path.join(tmp_dir, "sanitized" + cfg["PGN_EXT"]),
+            "by_elo": os.path.join(tmp_dir, str(rating) + cfg["PGN_EXT"]),
+            "stats_dir": tmp_dir,
+        }
+        for name, func, unit in STAGES:
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=stage_worker, args=(send_conn, func, paths, rating))
+            proc.start()
+            send_conn.close()   # Else recv() never sees EOF if the stage dies without sending.
+            try:
+                result = recv_conn.recv()
+            except EOFError:
+                result = {"error": "No result."}
+            proc.join()
+            if "error" in result or proc.exitcode != 0:
+                raise RuntimeError(cli_util.error(
+                    f'Stage {name} failed (exit code {proc.exitcode}):\n{result.get("error", "")}'))
+            result["unit"] = unit
+            results[name] = result
+    return results
+
+
+def compare_to_baseline(results, baseline):
+    # Flag throughput drops and RSS growth beyond TOLERANCE.
+    tol = BENCH_CFG["TOLERANCE"]
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["items_per_s"] < base["items_per_s"] * (1 - tol):
+            regressions.append(f'{name}: {result["items_per_s"]} {result["unit"]}/s (baseline {base["items_per_s"]})')
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tol):
+            regressions.append(f'{name}: {result["peak_rss_mb"]} MB peak RSS (baseline {base["peak_rss_mb"]})')
+    return regressions
+
+
+def print_results(results):
+    print(cli_util.header(f'{"Stage":<24}{"Seconds":>10}{"Items/s":>22}{"MB/s":>10}{"Peak RSS MB":>14}'))
+    for name, r in results.items():
+        rate = f'{r["items_per_s"]} {r["unit"]}/s'
+        print(f'{name:<24}{r["seconds"]:>10}{rate:>22}{r["mb_per_s"]:>10}{r["peak_rss_mb"]:>14}')
+
+
+def load_baselines():
+    if not os.path.exists(BENCH_CFG["BASELINE"]):
+        return {}
+    with open(BENCH_CFG["BASELINE"], 'r') as baseline_file:
+        return json.load(baseline_file)
+
+def save_baseline(results, num_games):
+    baselines = load_baselines()
+    baselines[str(num_games)] = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "stages": results,
+    }
+    os.makedirs(os.path.dirname(BENCH_CFG["BASELINE"]), exist_ok=True)
+    with open(BENCH_CFG["BASELINE"], 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=4)
+    print(cli_util.success(f"Saved baseline for {num_games} games to {BENCH_CFG['BASELINE']}."))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic PGNs.")
+    parser.add_argument("--games", type=int, default=BENCH_CFG["NUM_GAMES"])
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.games)
+    print_results(results)
+
+    baseline = load_baselines().get(str(args.games))
+    if baseline is None:
+        print(cli_util.warn(f"No baseline for {args.games} games. Use --save-baseline to store one."))
+    else:
+        regressions = compare_to_baseline(results, baseline["stages"])
+        for regression in regressions:
+            print(cli_util.error(f"REGRESSION {regression}"))
+        if not regressions:
+            print(cli_util.success("No regressions against baseline."))
+    if args.save_baseline:
+        save_baseline(results, args.games)
@@ -0,0 +1,180 @@
+import os
+import json
+
+import chess
+import numpy as np
+
+from cli_util import error, warn, success
+from parse_pgn import parse_game
+from analyze_sample import build_stats_path, read_stats
+from analyze_opening import OPENINGS, get_entry_color, write_opening_stats
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+LABELS = cfg["STAT_LABEL"]
+CI_SUFFIX = cfg["CI_SUFFIX"]
+
+NUM_SAMPLES = cfg["BOOTSTRAP"]["NUM_SAMPLES"]
+CI = cfg["BOOTSTRAP"]["CI"]
+PRIOR = cfg["BOOTSTRAP"]["PRIOR"]
+SEED = cfg["BOOTSTRAP"]["SEED"]
+
+'''
+Every stat is recomputed NUM_SAMPLES times at once: each value that calc_attainability()
+and calc_winrate() treat as a scalar is an array over the resample axis here.
+Move probabilities at a node are drawn from Dirichlet(child counts, rest), where rest is
+the games that ended or left the tree at that node, so siblings stay consistent.
+Every count gets PRIOR added: with raw counts as alphas, an outcome with no games would
+ always sample 0 and an only child would always sample p = 1 (zero-width intervals).
+'''
+
+
+def build_decision_tree(lines):
+    # Same tree as calc_attainability(): main line first, then transpositions.
+    tree_root = {}
+    for line in lines:
+        cur_obj = tree_root
+        for move in line:
+            if move not in cur_obj:
+                cur_obj[move] = {}
+            cur_obj = cur_obj[move]
+    return tree_root
+
+
+def sample_move_probs(rng, stats_obj, moves):
+    counts = [stats_obj[move]["stats"][LABELS["TOTAL"]] for move in moves]
+    rest = stats_obj["stats"][LABELS["TOTAL"]] - sum(counts)
+    alphas = np.array(counts + [rest], dtype=np.float64) + PRIOR
+    gammas = rng.standard_gamma(alphas[:, None], size=(len(alphas), NUM_SAMPLES))
+    gammas /= gammas.sum(axis=0)
+    return dict(zip(moves, gammas))
+
+
+def sample_attainability(rng, tree_root, stats_root, color, is_opposite_color):
+    # Vectorized calc_attainability(): see its comments for the sum/weighted sum/max cases.
+    zeros = np.zeros(NUM_SAMPLES)
+
+    def sample_att_inner(tree_obj, stats_obj, cur_color, move_probs):
+        moves = [move for move in tree_obj if move in stats_obj]
+        att_base = np.ones(NUM_SAMPLES)
+        if len(tree_obj) > 0:
+            if not moves:
+                return zeros    # No stats for any continuation.
+            probs = sample_move_probs(rng, stats_obj, moves)
+            atts = {move: sample_att_inner(tree_obj[move], stats_obj[move], not cur_color, probs[move])
+                for move in moves}
+
+            if len(tree_obj) == 1 or cur_color == color:
+                att_base = sum(atts.values())
+            elif is_opposite_color:
+                denom = sum(probs.values())
+                att_base = sum(atts[move] * (probs[move] / denom) for move in moves)
+            else:
+                # Best try is picked per resample, not fixed to the point-estimate BTL.
+                att_base = np.max(np.stack(list(atts.values())), axis=0)
+
+        if cur_color != color and move_probs is not None:
+            att_base = att_base * move_probs
+        return att_base
+
+    return sample_att_inner(tree_root, stats_root, chess.BLACK, None)
+
+
+def sample_winrate(rng, lines, stats_root):
+    # Vectorized calc_winrate(): results per line and games per line are both resampled.
+    results = []
+    tots = []
+    for line in lines:
+        cur_obj = stats_root
+        for move in line:
+            cur_obj = cur_obj.get(move)
+            if cur_obj is None:
+                break
+        if cur_obj is None:
+            continue
+        stats = cur_obj["stats"]
+        alphas = np.array([stats[LABELS[label]] for label in ["WIN-W", "WIN-B", "DRAW"]], dtype=np.float64) + PRIOR
+        gammas = rng.standard_gamma(alphas[:, None], size=(3, NUM_SAMPLES))
+        results.append(gammas / gammas.sum(axis=0))
+        tots.append(stats[LABELS["TOTAL"]])
+    if not tots:
+        return None
+
+    weights = rng.standard_gamma(np.array(tots, dtype=np.float64)[:, None] + PRIOR, size=(len(tots), NUM_SAMPLES))
+    weights /= weights.sum(axis=0)
+    white_wr, black_wr, _ = (weights[None] * np.stack(results, axis=1)).sum(axis=1)
+    return {
+        LABELS["WIN-W%"]: white_wr,
+        LABELS["WIN-B%"]: black_wr,
+        LABELS["DRAW%"]: 1 - white_wr - black_wr
+    }
+
+
+def calc_interval(samples):
+    tail = (1 - CI) / 2 * 100
+    lo, hi = np.percentile(samples, [tail, 100 - tail])
+    return [round(float(lo), 3), round(float(hi), 3)]
+
+
+def sample_opening_stats(rng, lines, stats_root, opening_color):
+    wr = sample_winrate(rng, lines, stats_root)
+    if wr is None:
+        return None
+    tree_root = build_decision_tree(lines)
+    samples = dict(wr)
+    samples[LABELS["PREV"]] = sample_attainability(rng, tree_root, stats_root, not opening_color, True)
+    samples[LABELS["ATTAIN"]] = sample_attainability(rng, tree_root, stats_root, opening_color, False)
+    return {label + CI_SUFFIX: calc_interval(s) for label, s in samples.items()}
+
+
+def update_stats_ci(opening, opening_obj, rating, stats_root, rng):
+    # Adds "<stat>_ci": [lo, hi] next to the stats written by update_stats_main()/update_stats().
+    # opening_obj: the entry to update, from the caller's catalog.
+    main = opening_obj["main"]
+    if main == "[SYSTEM]":
+        if DEBUG_MODE:
+            print(warn(f"Skipping system opening: {opening}"))
+        return
+    opening_color = get_entry_color(opening_obj)
+    main_line = parse_game(main)
+    transpositions = [parse_game(line) for line in opening_obj.get("transpositions", [])]
+
+    for key, lines in [("stats_main", [main_line]), ("stats", [main_line] + transpositions)]:
+        stats = opening_obj.get(key)
+        if not isinstance(stats, dict) or not stats.get(str(rating)):
+            continue    # "[USE MAIN]" or not computed at this rating.
+        intervals = sample_opening_stats(rng, lines, stats_root, opening_color)
+        if intervals is None:
+            if DEBUG_MODE:
+                print(warn(f"Skipping missing opening: {opening}"))
+            continue
+        stats[str(rating)].update(intervals)
+
+
+def update_opening_ci(opening, opening_obj, rating, stats_root):
+    # One opening on its own (after analyze_opening.update_opening() recomputed it).
+    update_stats_ci(opening, opening_obj, rating, stats_root, np.random.default_rng(SEED))
+
+
+def process_all_ratings(ratings=cfg["RATINGS"]):
+    rng = np.random.default_rng(SEED)
+    for rating in ratings:
+        if not os.path.exists(build_stats_path(rating)):
+            print(error(f"No stats for {rating}. Skipping..."))
+            continue
+        stats_root = read_stats(rating)
+        for opening in OPENINGS:
+            update_stats_ci(opening, OPENINGS[opening], rating, stats_root, rng)
+        print(success(f"Bootstrapped {len(OPENINGS)} openings at {rating} ({NUM_SAMPLES} resamples)."))
+    write_opening_stats()
+
+
+if __name__ == "__main__":
+    process_all_ratings()
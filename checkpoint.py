@@ -0,0 +1,63 @@
+import os
+import json
+
+import ujson
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+CKPT_CFG = cfg["CHECKPOINT"]
+CHECKPOINT_EVERY = CKPT_CFG["EVERY_GAMES"] if CKPT_CFG["ENABLED"] else float("inf")
+
+'''
+Checkpoints for long single-pass stages.
+A stage saves one at a game boundary, after flushing its output, with everything needed to
+ carry on: input position (a tell() cookie), output size, counters and any partial state.
+On resume the output is truncated back to that size and the input seeked, so the rest of
+ the run writes exactly what an uninterrupted run would have.
+'''
+
+
+def build_checkpoint_path(path):
+    return path + CKPT_CFG["SUFFIX"]
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+def save_checkpoint(ckpt_path, state):
+    tmp_path = ckpt_path + ".tmp"
+    with open(tmp_path, 'w') as ckpt_file:
+        ujson.dump(state, ckpt_file)
+    os.replace(tmp_path, ckpt_path)     # Atomic: a crash mid-write keeps the previous checkpoint.
+    if DEBUG_MODE:
+        print(cli_util.info(f"Checkpoint saved to {ckpt_path}."))
+
+
+def load_checkpoint(ckpt_path, src_path):
+    # Returns None (start from scratch) if there is no usable checkpoint.
+    if not os.path.exists(ckpt_path):
+        print(cli_util.warn(f"No checkpoint at {ckpt_path}. Starting from scratch."))
+        return None
+    with open(ckpt_path, 'r') as ckpt_file:
+        state = ujson.load(ckpt_file)
+    if state["input"] != fingerprint(src_path):
+        print(cli_util.warn(f"{src_path} changed since {ckpt_path} was saved. Starting from scratch."))
+        return None
+    print(cli_util.success(f"Resuming from {ckpt_path} ({state['num_read']} games in)."))
+    return state
+
+
+def clear_checkpoint(ckpt_path):
+    if os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
@@ -0,0 +1,245 @@
+import os
+import re
+import sys
+import json
+import math
+import struct
+
+import numpy as np
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+CLOCK_CFG = cfg["CLOCKS"]
+
+'''
+Clock times ({ [%clk h:mm:ss] }) kept out of the sanitized PGN, in a binary sidecar next
+ to it (<pgn>.clk). One record per game that has clocks, in file order:
+ uint64 offset of the game in the PGN, uint16 number of plies, uint16 seconds left per ply.
+ That's 2 bytes per ply instead of ~20 characters of comment.
+separate_by_elo() carries the records over to the by-elo files (with the new offsets), and
+ the counting pass turns them into think times, collected per tree node in log-bucket
+ sketches: quantiles within SKETCH_ACCURACY relative error, in a few dozen buckets per node.
+'''
+
+MAGIC = b"CLK1"
+RECORD_HEADER = struct.Struct("<QH")
+CLK_REGEX = re.compile(r"\[%clk (\d+):(\d\d):(\d\d)\]")
+MAX_CLOCK = 0xFFFF  # uint16 seconds (~18h), more than any classical clock.
+
+
+def build_clock_path(pgn_path):
+    return pgn_path + CLOCK_CFG["SUFFIX"]
+
+def build_think_times_path(rating):
+    return os.path.join(cfg["STATS_DIR"], f"{rating}{CLOCK_CFG['TIMES_SUFFIX']}{cfg['JSON_EXT']}")
+
+
+def parse_clocks(line):
+    return [min(int(h)*3600 + int(m)*60 + int(s), MAX_CLOCK) for h, m, s in CLK_REGEX.findall(line)]
+
+
+def parse_time_control(value):
+    # "600+5" -> (600, 5). None for correspondence ("-") or anything unexpected.
+    base, _, inc = value.partition("+")
+    if not (base.isdigit() and inc.isdigit()):
+        return None
+    return int(base), int(inc)
+
+
+def think_times(clocks, time_control):
+    # Seconds spent on each ply: own previous clock - clock + increment. Each side's first
+    #  move is against the base time, and Lichess adds no increment for it.
+    base, inc = time_control
+    return [max(clocks[i-2] - clocks[i] + inc, 0) if i >= 2 else max(base - clocks[i], 0)
+        for i in range(len(clocks))]
+
+
+def header_offset(pgn_file, headers):
+    # Offset of the game whose headers were just read (pgn_file is past them and the blank line).
+    return pgn_file.tell() - len(headers.encode()) - 1
+
+def next_game_offset(offset, headers, movetext):
+    # Offset of the game after a fully read one, without tell() (slow on text files).
+    # Sidecars only sit next to PGNs this pipeline wrote: headers, blank line, one movetext line, blank line.
+    return offset + len(headers.encode()) + len(movetext.encode()) + 2
+
+
+class ClockWriter:
+    def __init__(self, path, resume_offset=None):
+        # resume_offset: from a checkpoint; the sidecar is cut back to it.
+        if resume_offset is not None:
+            os.truncate(path, resume_offset)
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(MAGIC)
+        self.num_records = 0
+
+    def write(self, offset, clocks):
+        self.file.write(RECORD_HEADER.pack(offset, len(clocks)))
+        self.file.write(np.asarray(clocks, dtype="<u2").tobytes())
+        self.num_records += 1
+
+    def tell(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ClockReader:
+    # Sequential lookups: get() is called with increasing offsets (games in file order).
+    def __init__(self, path, resume_offset=None):
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(cli_util.error(f"{path} is not a clock sidecar."))
+        if resume_offset is not None:
+            self.file.seek(resume_offset)
+        self.next = self._read_record()
+
+    def _read_record(self):
+        header = self.file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        offset, num_plies = RECORD_HEADER.unpack(header)
+        return offset, np.frombuffer(self.file.read(2 * num_plies), dtype="<u2")
+
+    def get(self, offset):
+        # Clocks of the game at offset, or None if it had none. Skips records before it.
+        while self.next is not None and self.next[0] < offset:
+            self.next = self._read_record()
+        if self.next is None or self.next[0] != offset:
+            return None
+        clocks = self.next[1]
+        self.next = self._read_record()
+        return clocks
+
+    def tell(self):
+        # Position of the next unread record (for checkpoints).
+        if self.next is None:
+            return self.file.tell()
+        return self.file.tell() - RECORD_HEADER.size - 2 * len(self.next[1])
+
+    def close(self):
+        self.file.close()
+
+
+def open_clock_reader(pgn_path, resume_offset=None):
+    # None if pgn_path has no sidecar.
+    clock_path = build_clock_path(pgn_path)
+    if not os.path.exists(clock_path):
+        if DEBUG_MODE:
+            print(cli_util.warn(f"No clock sidecar at {clock_path}."))
+        return None
+    return ClockReader(clock_path, resume_offset)
+
+
+class TimeSketch:
+    # Log-bucket quantile sketch: bucket i >= 1 holds [gamma^(i-1), gamma^i) seconds, bucket 0 holds < 1s.
+    def __init__(self, accuracy=CLOCK_CFG["SKETCH_ACCURACY"]):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, seconds):
+        index = int(math.log(seconds) / self.log_gamma) + 1 if seconds >= 1 else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        if index == 0:
+            return 0.0
+        return 2 * self.gamma ** index / (self.gamma + 1)   # Within accuracy of any value in the bucket.
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        return self
+
+    def state(self):
+        return {"n": self.count, "buckets": {str(index): count for index, count in sorted(self.buckets.items())}}
+
+    @classmethod
+    def from_state(cls, state, accuracy=CLOCK_CFG["SKETCH_ACCURACY"]):
+        obj = cls(accuracy)
+        obj.buckets = {int(index): count for index, count in state["buckets"].items()}
+        obj.count = state["n"]
+        return obj
+
+
+class NodeTimes:
+    # Think-time sketches per move-tree node, keyed by the space-joined moves leading to it.
+    def __init__(self, accuracy=CLOCK_CFG["SKETCH_ACCURACY"]):
+        self.accuracy = accuracy
+        self.sketches = {}
+
+    def add_game(self, moves, clocks, time_control):
+        if time_control is None or len(clocks) < len(moves):
+            return False
+        for i, seconds in enumerate(think_times(clocks[:len(moves)].tolist(), time_control)):
+            path = " ".join(moves[:i+1])
+            sketch = self.sketches.get(path)
+            if sketch is None:
+                sketch = self.sketches[path] = TimeSketch(self.accuracy)
+            sketch.add(seconds)
+        return True
+
+    def state(self):
+        return {"accuracy": self.accuracy, "nodes": {path: sketch.state() for path, sketch in self.sketches.items()}}
+
+    @classmethod
+    def from_state(cls, state):
+        obj = cls(state["accuracy"])
+        obj.sketches = {path: TimeSketch.from_state(s, obj.accuracy) for path, s in state["nodes"].items()}
+        return obj
+
+    def write(self, out_path):
+        out_obj = {"accuracy": self.accuracy, "nodes": {}}
+        for path, sketch in self.sketches.items():
+            out_obj["nodes"][path] = {
+                "median": round(sketch.quantile(0.5), 1),
+                "p90": round(sketch.quantile(0.9), 1),
+                **sketch.state(),
+            }
+        with open(out_path, 'w') as out_file:
+            json.dump(out_obj, out_file, indent=4)
+        if DEBUG_MODE:
+            print(cli_util.success(f"Wrote think times for {len(self.sketches)} nodes to {out_path}."))
+
+
+def read_think_times(path):
+    with open(path, 'r') as times_file:
+        return NodeTimes.from_state(json.load(times_file))
+
+
+if __name__ == "__main__":
+    # python clock_sidecar.py <pgn>: summary of its sidecar.
+    reader = open_clock_reader(sys.argv[1])
+    if reader is not None:
+        num_games = num_plies = 0
+        while reader.next is not None:
+            num_games += 1
+            num_plies += len(reader.next[1])
+            reader.next = reader._read_record()
+        size = os.path.getsize(build_clock_path(sys.argv[1]))
+        print(cli_util.info(f"{num_games} games, {num_plies} clocks in {size} bytes."))
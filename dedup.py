@@ -0,0 +1,170 @@
+import os
+import json
+import math
+import struct
+import hashlib
+
+import numpy as np
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+DEDUP_CFG = cfg["DEDUP"]
+
+'''
+Duplicate-game detection for sanitize_games().
+Games are keyed on their URL header (Site/LichessURL, removed from the output anyway), or
+ on the original players/event/timestamp headers if there is none.
+With DEDUP.FILTER_DIR set, each source PGN's filter is saved there under the source's name,
+ and index.json lists the sources in the order they were first deduplicated. A source is
+ checked against itself and the sources before it, so dumps sanitized one after another are
+ deduplicated against each other, and re-sanitizing a dump (after a TC change, say) gives
+ the same games as the first time instead of dropping them all as already seen.
+'''
+
+# Headers that identify a game on Lichess (standard DB, Elite DB).
+ID_HEADERS = ["Site", "LichessURL"]
+# Otherwise, who played it and when (all in sanitize_pgn.HEADERS_TO_REMOVE, so read_headers() keeps them).
+GAME_HEADERS = ["Event", "Site", "White", "Black", "UTCDate", "UTCTime", "Date", "Round"]
+INDEX_NAME = "index.json"
+
+
+class BloomFilter:
+    '''
+    Fixed-size probabilistic set: memory depends only on capacity and error rate, never on
+     how many games go through it. A false positive drops a unique game as a "duplicate"
+     with probability ~error_rate once the filter is at capacity; duplicates are never missed.
+    '''
+    HEADER = struct.Struct("<QI")   # num_bits, num_hashes
+
+    def __init__(self, capacity, error_rate, num_bits=None, num_hashes=None, bits=None):
+        if num_bits is None:
+            num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2)**2)
+            num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i*h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        # Returns True if key was (probably) seen before.
+        seen = True
+        bits = self.bits
+        for pos in self.positions(key):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                seen = False
+                bits[pos >> 3] |= mask
+        return seen
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+    def union(self, other):
+        # In place; both must have the same size and number of hashes.
+        if (other.num_bits, other.num_hashes) != (self.num_bits, self.num_hashes):
+            raise ValueError(cli_util.error("Cannot merge Bloom filters of different sizes "
+                "(DEDUP.CAPACITY or ERROR_RATE changed): clear DEDUP.FILTER_DIR."))
+        np.bitwise_or(np.frombuffer(self.bits, dtype=np.uint8), np.frombuffer(other.bits, dtype=np.uint8),
+            out=np.frombuffer(self.bits, dtype=np.uint8))
+        return self
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as bloom_file:
+            bloom_file.write(self.HEADER.pack(self.num_bits, self.num_hashes))
+            bloom_file.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as bloom_file:
+            num_bits, num_hashes = cls.HEADER.unpack(bloom_file.read(cls.HEADER.size))
+            bits = bytearray(bloom_file.read())
+        return cls(None, None, num_bits, num_hashes, bits)
+
+
+class SeenGames:
+    # Games of one source PGN: its own filter, plus the union of the earlier sources' (or None).
+    def __init__(self, source, own, earlier=None):
+        self.source = source
+        self.own = own
+        self.earlier = earlier
+
+    def add(self, key):
+        # Returns True if key is (probably) a duplicate.
+        seen = self.own.add(key)
+        return seen or (self.earlier is not None and key in self.earlier)
+
+    def save(self, path):
+        # Own filter only, e.g. for checkpoints (open_filter(resume_path=path)).
+        self.own.save(path)
+
+
+def build_filter_path(source, filter_dir=DEDUP_CFG["FILTER_DIR"]):
+    return os.path.join(filter_dir, f"{source}{DEDUP_CFG['SUFFIX']}")
+
+def read_index(filter_dir):
+    index_path = os.path.join(filter_dir, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)["sources"]
+
+
+def open_filter(source, filter_dir=DEDUP_CFG["FILTER_DIR"], resume_path=None):
+    # source: name of the input PGN. resume_path: its filter saved with a checkpoint.
+    own = BloomFilter.load(resume_path) if resume_path else BloomFilter(DEDUP_CFG["CAPACITY"], DEDUP_CFG["ERROR_RATE"])
+    if not filter_dir:
+        return SeenGames(source, own)
+    sources = read_index(filter_dir)
+    earlier_sources = sources[:sources.index(source)] if source in sources else sources
+    earlier = None
+    for earlier_source in earlier_sources:
+        if DEBUG_MODE:
+            print(cli_util.info(f"Loading seen games of {earlier_source} from {filter_dir}."))
+        loaded = BloomFilter.load(build_filter_path(earlier_source, filter_dir))
+        earlier = loaded if earlier is None else earlier.union(loaded)
+    return SeenGames(source, own, earlier)
+
+
+def save_filter(seen, filter_dir=DEDUP_CFG["FILTER_DIR"]):
+    # After a complete run over seen.source; no-op without FILTER_DIR.
+    if not filter_dir:
+        return
+    os.makedirs(filter_dir, exist_ok=True)
+    seen.own.save(build_filter_path(seen.source, filter_dir))
+    sources = read_index(filter_dir)
+    if seen.source not in sources:
+        sources.append(seen.source)
+        tmp_path = os.path.join(filter_dir, INDEX_NAME + ".tmp")
+        with open(tmp_path, 'w') as index_file:
+            json.dump({"sources": sources}, index_file, indent=4)
+        os.replace(tmp_path, os.path.join(filter_dir, INDEX_NAME))
+
+
+def game_key(removed_headers, headers, movetext):
+    # Game URL (e.g. lichess.org/<id>) if present, else who played it and when.
+    # removed_headers: the original values of the headers read_headers() removed.
+    for name in ID_HEADERS:
+        value = removed_headers.get(name, "")
+        if "/" in value:
+            return value.split("://")[-1].rstrip("/")
+    identity = [removed_headers.get(name, "") for name in GAME_HEADERS]
+    if any(identity):
+        return "\t".join(identity)
+    return headers + movetext   # Nothing to tell games apart but their content.
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+LABELS = cfg["STAT_LABEL"]
+HEADERS = cfg["PGN_HEADERS"]
+GROUP_CFG = cfg["GROUP_BY"]
+OPENINGS_JSON = cfg["OPENINGS_JSON"] + cfg["JSON_EXT"]
+
+'''
+Per-ECO and per-Lichess-opening-name result counts and rating histograms, collected in
+ the same pass as sanitize_games() or the counting stage (GROUP_BY.ENABLED).
+Names are interned, so each distinct ECO code / opening name is stored once however
+ many games carry it. Groups from separate shards (months, DBs) add up with merge().
+'''
+
+GROUP_FIELDS = [HEADERS["ECO"], HEADERS["OPENING"]]
+RESULT_INDEX = {"WIN-W": 1, "WIN-B": 2, "DRAW": 3}   # Index 0 is the total.
+COUNT_LABELS = [LABELS["TOTAL"], LABELS["WIN-W"], LABELS["WIN-B"], LABELS["DRAW"]]
+
+
+def build_groups_path(name):
+    return os.path.join(cfg["STATS_DIR"], f"{name}{GROUP_CFG['SUFFIX']}{cfg['JSON_EXT']}")
+
+
+class HeaderGroups:
+    def __init__(self, elo_bin=GROUP_CFG["ELO_BIN"]):
+        self.elo_bin = elo_bin
+        # field -> {name: [tot, w_t, b_t, d_t, {elo bin: count}]}
+        self.groups = {field: {} for field in GROUP_FIELDS}
+
+    def add(self, headers, result):
+        # headers: dict from parse_headers(), result: key of cfg["RESULTS"] values ("WIN-W", ...).
+        white_elo = headers.get(HEADERS["ELO-W"], "")
+        black_elo = headers.get(HEADERS["ELO-B"], "")
+        elo_bin = None
+        if white_elo.isdigit() and black_elo.isdigit():
+            elo_bin = (int(white_elo) + int(black_elo)) // 2 // self.elo_bin * self.elo_bin
+        result_index = RESULT_INDEX[result]
+        for field in GROUP_FIELDS:
+            name = headers.get(field)
+            if not name:
+                continue
+            group = self.groups[field]
+            row = group.get(name)
+            if row is None:
+                row = group[sys.intern(name)] = [0, 0, 0, 0, {}]
+            row[0] += 1
+            row[result_index] += 1
+            if elo_bin is not None:
+                row[4][elo_bin] = row[4].get(elo_bin, 0) + 1
+
+    def merge(self, other):
+        if other.elo_bin != self.elo_bin:
+            raise ValueError(cli_util.error(f"Cannot merge groups with Elo bins {other.elo_bin} and {self.elo_bin}."))
+        for field, other_group in other.groups.items():
+            group = self.groups.setdefault(field, {})
+            for name, other_row in other_group.items():
+                row = group.get(name)
+                if row is None:
+                    row = group[sys.intern(name)] = [0, 0, 0, 0, {}]
+                for i in range(4):
+                    row[i] += other_row[i]
+                for elo_bin, count in other_row[4].items():
+                    row[4][elo_bin] = row[4].get(elo_bin, 0) + count
+        return self
+
+    def state(self):
+        # JSON-ready form, also used in checkpoints.
+        return {
+            "elo_bin": self.elo_bin,
+            "groups": {field: {name: {**dict(zip(COUNT_LABELS, row[:4])),
+                    "elo": {str(elo_bin): count for elo_bin, count in sorted(row[4].items())}}
+                for name, row in sorted(group.items(), key=lambda item: (-item[1][0], item[0]))}
+                for field, group in self.groups.items()},
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        obj = cls(state["elo_bin"])
+        for field, group in state["groups"].items():
+            obj.groups[field] = {sys.intern(name): [*(row[label] for label in COUNT_LABELS),
+                    {int(elo_bin): count for elo_bin, count in row["elo"].items()}]
+                for name, row in group.items()}
+        return obj
+
+    def write(self, out_path):
+        with open(out_path, 'w') as out_file:
+            json.dump(self.state(), out_file, indent=4)
+        if DEBUG_MODE:
+            sizes = ", ".join(f"{len(group)} {field}" for field, group in self.groups.items())
+            print(cli_util.success(f"Wrote groups ({sizes}) to {out_path}."))
+
+
+def read_groups(path):
+    with open(path, 'r') as groups_file:
+        return HeaderGroups.from_state(json.load(groups_file))
+
+
+def merge_group_files(paths, out_path):
+    merged = HeaderGroups()
+    for path in paths:
+        merged.merge(read_groups(path))
+    merged.write(out_path)
+    return merged
+
+
+def cross_check(groups, rating, openings_path=OPENINGS_JSON):
+    # Catalog totals vs. the Lichess opening family of the same name ("Italian Game: ...").
+    with open(openings_path, 'r') as openings_file:
+        openings = json.load(openings_file)
+    families = {}
+    for name, row in groups.groups[HEADERS["OPENING"]].items():
+        family = name.split(":")[0]
+        families[family] = families.get(family, 0) + row[0]
+    num_total = sum(row[0] for row in groups.groups[HEADERS["ECO"]].values())
+
+    rows = []
+    for opening, opening_obj in openings.items():
+        stats_obj = opening_obj.get("stats")
+        if stats_obj == "[USE MAIN]":
+            stats_obj = opening_obj.get("stats_main")
+        catalog_tot = (stats_obj or {}).get(str(rating), {}).get(LABELS["TOTAL"])
+        lichess_tot = families.get(opening)
+        if catalog_tot is None and lichess_tot is None:
+            continue
+        rows.append((opening, catalog_tot, lichess_tot))
+        if DEBUG_MODE:
+            share = f"{lichess_tot / num_total:.2%}" if lichess_tot and num_total else "-"
+            print(cli_util.info(f"{opening:<32} catalog: {catalog_tot if catalog_tot is not None else '-':>9}  "
+                f"lichess name: {lichess_tot if lichess_tot is not None else '-':>9} ({share})"))
+    return rows
+
+
+if __name__ == "__main__":
+    # python eco_groupby.py merge <out> <in>...  |  python eco_groupby.py check <groups> <rating>
+    if len(sys.argv) >= 4 and sys.argv[1] == "merge":
+        merge_group_files(sys.argv[3:], sys.argv[2])
+    elif len(sys.argv) == 4 and sys.argv[1] == "check":
+        cross_check(read_groups(sys.argv[2]), sys.argv[3])
+    else:
+        print(cli_util.warn("Usage: eco_groupby.py merge <out> <in>... | check <groups.json> <rating>"))
@@ -0,0 +1,238 @@
+import os
+import json
+from array import array
+
+import numpy as np
+
+import cli_util
+from parse_pgn import read_headers, parse_headers, read_game, parse_game
+from analyze_sample import (has_valid_result, get_result, init_stats_dict,
+    normalize_counts, write_stats)
+from sample_by_elo import PGN_PATH
+from prefetch_reader import open_pgn
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+
+STATS_DEPTH = cfg["STATS_DEPTH"]
+LABELS = cfg["STAT_LABEL"]
+HEADERS = cfg["PGN_HEADERS"]
+
+# Each game lands in one cell of (lower player's Elo bin, gap to higher player's bin, TC class, result).
+# Storing the pair of bins (rather than a single average) lets a window query require
+#  BOTH players to be in range, same as players_in_rating().
+# Bins alternate between an edge (ELO_MIN + k*BIN_WIDTH exactly) and the open interval up
+#  to the next edge, with one bin below ELO_MIN and one above ELO_MAX. So a window between
+#  two edges is exact whether its bounds are inclusive ([1400, 1600]) or not.
+ELO_MIN = cfg["HISTOGRAM"]["ELO_MIN"]
+ELO_MAX = cfg["HISTOGRAM"]["ELO_MAX"]
+BIN_WIDTH = cfg["HISTOGRAM"]["BIN_WIDTH"]
+NUM_BINS = 2 * ((ELO_MAX - ELO_MIN) // BIN_WIDTH) + 3
+NUM_GAPS = 2 * (cfg["HISTOGRAM"]["MAX_GAP"] // BIN_WIDTH) + 2     # Last gap bin is overflow.
+TC_CLASSES = list(cfg["TC"])
+RESULT_LABELS = list(cfg["RESULTS"].values())
+NUM_CELLS = NUM_BINS * NUM_GAPS * len(TC_CLASSES) * len(RESULT_LABELS)
+LAYOUT = [ELO_MIN, BIN_WIDTH, NUM_BINS, NUM_GAPS, len(TC_CLASSES), len(RESULT_LABELS)]
+
+# A time control may be listed under several classes: first one wins.
+TC_CLASS_INDEX = {}
+for i, tc_class in enumerate(TC_CLASSES):
+    for tc in cfg["TC"][tc_class]:
+        TC_CLASS_INDEX.setdefault(tc, i)
+RESULT_INDEX = {label: i for i, label in enumerate(RESULT_LABELS)}
+
+FLUSH_SIZE = 1 << 20    # Pending (node, cell) increments before folding into the sparse counts.
+
+
+def build_hist_path(src_path, depth=STATS_DEPTH):
+    name = os.path.splitext(os.path.basename(src_path))[0]
+    return os.path.join(cfg["STATS_DIR"],
+        f'{name}{cfg["HIST_SUFFIX"]}{cfg["DEPTH_SUFFIX"]}{depth}{cfg["NPZ_EXT"]}')
+
+def build_hist_stats_path(rating, depth=STATS_DEPTH):
+    # Stats queried from the histograms, next to (not over) the counting stage's.
+    return os.path.join(cfg["STATS_DIR"],
+        f'{rating}{cfg["HIST_SUFFIX"]}{cfg["DEPTH_SUFFIX"]}{depth}{cfg["JSON_EXT"]}')
+
+
+def elo_to_bin(elo):
+    if elo < ELO_MIN:
+        return 0
+    if elo > ELO_MAX:
+        return NUM_BINS - 1
+    edge, rest = divmod(elo - ELO_MIN, BIN_WIDTH)
+    return 1 + 2*edge + (rest > 0)
+
+def edge_to_bin(elo):
+    # Bin of a window bound, which must be an edge.
+    if (elo - ELO_MIN) % BIN_WIDTH or not ELO_MIN <= elo <= ELO_MAX:
+        raise ValueError(cli_util.error(f"Window bound {elo} is not a bin edge "
+            f"({ELO_MIN} + k*{BIN_WIDTH}, up to {ELO_MAX}): the query would not be exact."))
+    return elo_to_bin(elo)
+
+
+def get_cell(headers):
+    # Returns None if the game cannot be placed (unrated player, unknown TC).
+    elo_w = headers.get(HEADERS["ELO-W"], "")
+    elo_b = headers.get(HEADERS["ELO-B"], "")
+    if not (elo_w.isdigit() and elo_b.isdigit()):
+        return None
+    tc = TC_CLASS_INDEX.get(headers.get(HEADERS["TIME"]))
+    if tc is None:
+        return None
+    low_bin, high_bin = sorted((elo_to_bin(int(elo_w)), elo_to_bin(int(elo_b))))
+    gap = min(high_bin - low_bin, NUM_GAPS - 1)
+    result = RESULT_INDEX[get_result(headers)]
+    return ((low_bin*NUM_GAPS + gap)*len(TC_CLASSES) + tc)*len(RESULT_LABELS) + result
+
+
+def merge_counts(keys, counts, new_keys):
+    # Sparse (key -> count) arrays sorted by key; keys are node_id*NUM_CELLS + cell.
+    # Only the new chunk is sorted, then merged in: a flush costs O(chunk log chunk + total)
+    #  instead of re-sorting everything counted so far.
+    new_keys, new_counts = np.unique(new_keys, return_counts=True)
+    pos = np.searchsorted(keys, new_keys)
+    found = pos < len(keys)
+    found[found] = keys[pos[found]] == new_keys[found]
+    counts = counts.copy()
+    counts[pos[found]] += new_counts[found]
+    missing = ~found
+    return np.insert(keys, pos[missing], new_keys[missing]), np.insert(counts, pos[missing], new_counts[missing])
+
+
+def get_histograms(pgn_path=PGN_PATH, depth=STATS_DEPTH):
+    # One pass over a sanitized file (any ratings, any TC).
+    # Nodes are numbered in order of first appearance, so parents precede children.
+    node_ids = {}   # (parent_id, move) -> node_id
+    parents = [-1]
+    moves = [""]
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    pending = array("q")
+    num_games = 0
+    num_skipped = 0
+
+    with open_pgn(pgn_path) as pgn_file:
+        while True:
+            try:
+                headers = read_headers(pgn_file, cond=has_valid_result)
+            except EOFError:
+                break
+            if headers == "":   # Game was skipped (invalid result).
+                continue
+
+            cell = get_cell(parse_headers(headers))
+            game = parse_game(read_game(pgn_file))
+            if cell is None:
+                num_skipped += 1
+                if EXTRA_DEBUG_MODE:
+                    print(cli_util.info(f"Cannot bin game: {headers}"))
+                continue
+
+            node_id = 0
+            pending.append(cell)
+            for move in game[:depth]:
+                child_id = node_ids.get((node_id, move))
+                if child_id is None:
+                    child_id = len(parents)
+                    node_ids[(node_id, move)] = child_id
+                    parents.append(node_id)
+                    moves.append(move)
+                node_id = child_id
+                pending.append(node_id*NUM_CELLS + cell)
+            num_games += 1
+
+            if len(pending) >= FLUSH_SIZE:
+                keys, counts = merge_counts(keys, counts, np.frombuffer(pending, dtype=np.int64))
+                pending = array("q")
+
+    keys, counts = merge_counts(keys, counts, np.frombuffer(pending, dtype=np.int64))
+    print(cli_util.success(f"{num_games} games binned into {len(parents)} nodes ({num_skipped} skipped)."))
+    return {
+        "parents": np.array(parents, dtype=np.int64),
+        "moves": np.array(moves),
+        "keys": keys,
+        "counts": counts,
+    }
+
+
+def write_histograms(hist, hist_path):
+    np.savez_compressed(hist_path, layout=np.array(LAYOUT), **hist)
+    print(cli_util.success(f"Wrote histograms to {hist_path}."))
+
+
+def read_histograms(hist_path):
+    with np.load(hist_path) as store:
+        if store["layout"].tolist() != LAYOUT:
+            raise RuntimeError(cli_util.error(
+                f"{hist_path} was built with a different HISTOGRAM/TC config. Rebuild it."))
+        return {k: store[k] for k in ["parents", "moves", "keys", "counts"]}
+
+
+def query_counts(hist, elo_lo, elo_hi, tc_classes=None):
+    # Sum bins into a counts tree (same shape as get_counts_by_rating()) for games with
+    #  both players in [elo_lo, elo_hi]. Both bounds must be bin edges.
+    # Exact for windows up to MAX_GAP wide; wider windows miss games in the overflow gap bin.
+    if elo_hi - elo_lo > cfg["HISTOGRAM"]["MAX_GAP"]:
+        print(cli_util.warn(f"Window [{elo_lo}, {elo_hi}] is wider than MAX_GAP: "
+            "games with a larger rating gap are not counted."))
+    num_results = len(RESULT_LABELS)
+    node_ids, cells = np.divmod(hist["keys"], NUM_CELLS)
+    cells, results = np.divmod(cells, num_results)
+    cells, tcs = np.divmod(cells, len(TC_CLASSES))
+    low_bins, gaps = np.divmod(cells, NUM_GAPS)
+
+    bin_lo = edge_to_bin(elo_lo)
+    bin_hi = edge_to_bin(elo_hi)
+    mask = (low_bins >= bin_lo) & (low_bins + gaps <= bin_hi) & (gaps < NUM_GAPS - 1)
+    if tc_classes is not None:
+        mask &= np.isin(tcs, [TC_CLASSES.index(tc_class) for tc_class in tc_classes])
+
+    num_nodes = len(hist["parents"])
+    totals = np.bincount(node_ids[mask]*num_results + results[mask],
+        weights=hist["counts"][mask], minlength=num_nodes*num_results)
+    totals = totals.astype(np.int64).reshape(num_nodes, num_results)
+    return build_counts_tree(hist, totals)
+
+
+def query_counts_by_rating(hist, rating, tc_classes=None):
+    # Same games as separate_by_elo(): both players within RATING_DEV, inclusive.
+    return query_counts(hist, rating - cfg["RATING_DEV"], rating + cfg["RATING_DEV"], tc_classes)
+
+
+def build_counts_tree(hist, totals):
+    parents = hist["parents"].tolist()
+    moves = hist["moves"].tolist()
+    totals = totals.tolist()
+    objs = [None] * len(parents)
+    for node_id, row in enumerate(totals):
+        if node_id > 0 and sum(row) == 0:
+            continue    # No games in this slice; children are empty too.
+        stats = init_stats_dict()
+        stats[LABELS["TOTAL"]] = sum(row)
+        for label, count in zip(RESULT_LABELS, row):
+            stats[LABELS[label]] = count
+        objs[node_id] = {"stats": stats}
+        if node_id > 0:
+            objs[parents[node_id]][moves[node_id]] = objs[node_id]
+    return objs[0]
+
+
+if __name__ == "__main__":
+    hist_path = build_hist_path(PGN_PATH)
+    write_histograms(get_histograms(PGN_PATH), hist_path)
+
+    hist = read_histograms(hist_path)
+    for rating in [r for r in cfg["RATINGS"] if r != "MASTERS"]:
+        root_obj = query_counts_by_rating(hist, rating)
+        if root_obj["stats"][LABELS["TOTAL"]] == 0:
+            print(cli_util.warn(f"No games at {rating} in {hist_path}."))
+            continue
+        write_stats(normalize_counts(root_obj), rating, build_hist_stats_path(rating))
@@ -0,0 +1,166 @@
+import os
+import json
+
+import chess
+
+from cli_util import error, warn, success
+from profiling import profiled
+from analyze_sample import build_stats_path, read_stats
+from analyze_opening import get_opening_color
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+OPENINGS_JSON = cfg["OPENINGS_JSON"] + cfg["JSON_EXT"]
+LABELS = cfg["STAT_LABEL"]
+RATINGS = cfg["RATINGS"]
+COLUMNAR_CFG = cfg["COLUMNAR"]
+
+'''
+Columnar (Parquet or Arrow IPC) export of the stats trees and openings.json, for notebooks.
+- stats_nodes: one row per move-tree node, all ratings stacked.
+- openings: one row per (opening, rating, main line only / with transpositions).
+- winrates: split_wr_rating() equivalent, pivoted from the openings table directly.
+'''
+
+COUNT_FIELDS = ["TOTAL", "WIN-W", "WIN-B", "DRAW"]
+PROB_FIELDS = ["MOVE%", "WIN-W%", "WIN-B%", "DRAW%"]
+OPENING_FIELDS = ["TOTAL", "WIN-W%", "DRAW%", "WIN-B%", "PREV", "PREV_INV", "ATTAIN", "ATTAIN_INV"]
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError(error("Columnar export needs pyarrow: pip install pyarrow"))
+
+
+def build_columnar_path(name):
+    ext = ".parquet" if COLUMNAR_CFG["FORMAT"] == "parquet" else ".arrow"
+    return os.path.join(cfg["STATS_DIR"], f"{name}{ext}")
+
+
+def write_table(table, name):
+    out_path = build_columnar_path(name)
+    if COLUMNAR_CFG["FORMAT"] == "parquet":
+        pq.write_table(table, out_path, compression=COLUMNAR_CFG["COMPRESSION"])
+    else:
+        feather.write_feather(table, out_path, compression=COLUMNAR_CFG["COMPRESSION"])
+    print(success(f"Wrote {table.num_rows} rows to {out_path}."))
+
+
+def flatten_stats_tree(root_obj, columns, rating):
+    # Pre-order walk; node ids are global across ratings so parent_id stays unique.
+    stack = [(root_obj, -1, 0, "", "")]
+    while stack:
+        obj, parent_id, depth, move, path = stack.pop()
+        node_id = len(columns["node_id"])
+        stats = obj["stats"]
+        columns["node_id"].append(node_id)
+        columns["parent_id"].append(parent_id)
+        columns["rating"].append(str(rating))
+        columns["depth"].append(depth)
+        columns["move"].append(move)
+        columns["path"].append(path)
+        for field in COUNT_FIELDS + PROB_FIELDS:
+            columns[LABELS[field]].append(stats.get(LABELS[field]))
+        children = [k for k in obj if k != "stats"]
+        for child in reversed(children):
+            stack.append((obj[child], node_id, depth + 1, child, f"{path} {child}" if path else child))
+
+
+def stats_nodes_table(ratings=RATINGS):
+    require_pyarrow()
+    columns = {name: [] for name in ["node_id", "parent_id", "rating", "depth", "move", "path"]}
+    columns.update({LABELS[field]: [] for field in COUNT_FIELDS + PROB_FIELDS})
+    for rating in ratings:
+        if not os.path.exists(build_stats_path(rating)):
+            print(warn(f"No stats for {rating}. Skipping..."))
+            continue
+        flatten_stats_tree(read_stats(rating), columns, rating)
+
+    types = {"node_id": pa.int64(), "parent_id": pa.int64(), "rating": pa.dictionary(pa.int8(), pa.string()),
+        "depth": pa.int8(), "move": pa.string(), "path": pa.string()}
+    types.update({LABELS[field]: pa.int64() for field in COUNT_FIELDS})
+    types.update({LABELS[field]: pa.float64() for field in PROB_FIELDS})
+    return pa.table({name: pa.array(values, type=types[name]) for name, values in columns.items()})
+
+
+def openings_table(openings):
+    require_pyarrow()
+    columns = {name: [] for name in ["opening", "color", "main_line", "rating", "transpositions"]}
+    columns.update({LABELS[field]: [] for field in OPENING_FIELDS})
+    columns["BTL"] = []
+
+    for opening, opening_obj in openings.items():
+        color = "White" if get_opening_color(opening) == chess.WHITE else "Black"
+        main_line = opening_obj.get("main_real", opening_obj["main"])
+        stats_all = opening_obj.get("stats", {})
+        if stats_all == "[USE MAIN]":
+            stats_all = opening_obj.get("stats_main", {})
+        for with_trans, stats_obj in [(False, opening_obj.get("stats_main", {})), (True, stats_all)]:
+            for rating in RATINGS:
+                rating_obj = stats_obj.get(str(rating))
+                if not rating_obj:
+                    continue
+                columns["opening"].append(opening)
+                columns["color"].append(color)
+                columns["main_line"].append(main_line)
+                columns["rating"].append(str(rating))
+                columns["transpositions"].append(with_trans)
+                for field in OPENING_FIELDS:
+                    columns[LABELS[field]].append(rating_obj.get(LABELS[field]))
+                columns["BTL"].append(rating_obj.get("BTL"))
+
+    types = {"opening": pa.string(), "color": pa.dictionary(pa.int8(), pa.string()),
+        "main_line": pa.string(), "rating": pa.dictionary(pa.int8(), pa.string()),
+        "transpositions": pa.bool_(), "BTL": pa.string()}
+    types.update({LABELS[field]: pa.float64() for field in OPENING_FIELDS})
+    types[LABELS["TOTAL"]] = pa.int64()
+    for field in ["PREV_INV", "ATTAIN_INV"]:
+        types[LABELS[field]] = pa.int64()
+    return pa.table({name: pa.array(values, type=types[name]) for name, values in columns.items()})
+
+
+def winrates_table(openings_tbl):
+    # Same rows as split_wr_rating(), without the CSV round-trip.
+    tbl = openings_tbl.filter(pc.field("transpositions"))
+    rating = pc.cast(tbl["rating"], pa.string())
+    white, draw, black = (tbl[LABELS[field]] for field in ["WIN-W%", "DRAW%", "WIN-B%"])
+    return pa.table({
+        "opening": tbl["opening"],
+        "rating": pc.if_else(pc.equal(rating, "MASTERS"), "2200+", rating),
+        "num_games": tbl[LABELS["TOTAL"]],
+        "white_wins": white,
+        "draw": draw,
+        "black_wins": black,
+        "white_wins_or_draws": pc.add(white, draw),
+        "black_wins_or_draws": pc.add(black, draw),
+    })
+
+
+@profiled
+def export_columnar():
+    require_pyarrow()
+    with open(OPENINGS_JSON, 'r') as openings_file:
+        openings = json.load(openings_file)
+    openings_tbl = openings_table(openings)
+    write_table(stats_nodes_table(), "stats_nodes")
+    write_table(openings_tbl, "openings")
+    write_table(winrates_table(openings_tbl), "winrates")
+
+
+if __name__ == "__main__":
+    export_columnar()
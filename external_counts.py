@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import heapq
+import shutil
+import tempfile
+from operator import itemgetter
+
+import ujson
+
+import cli_util
+import metrics
+import analyze_sample
+from profiling import profiled
+from prefetch_reader import open_pgn
+from parse_pgn import read_headers, parse_headers, read_game, parse_game
+from analyze_sample import build_sample_path, build_stats_path, get_result, has_valid_result
+from eco_groupby import HeaderGroups, build_groups_path
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+LABELS = cfg["STAT_LABEL"]
+EXT_CFG = cfg["EXTERNAL_COUNTS"]
+
+'''
+Out-of-core version of get_counts_by_rating() + normalize_counts() + write_stats().
+Each game adds 1 to (move-path prefix, result) for every prefix up to the depth. Counts
+ are combined in a dict until it reaches MAX_BUFFER_MB, then spilled as a sorted run.
+ Runs are k-way merged (MERGE_FAN_IN at a time, in several passes if needed), and the
+ merged stream is written straight to the stats JSON without building the tree.
+Paths are space-joined SANs: space sorts below every SAN character, so sorted paths are
+ a pre-order walk (a node, then its whole subtree). Children come out in sorted order
+ rather than first-seen order; the values are the same as the in-memory version.
+'''
+
+RESULT_INDEX = {"WIN-W": 1, "WIN-B": 2, "DRAW": 3}   # Index 0 is the total.
+ENTRY_BYTES = 250   # Rough CPython cost of one buffered prefix (dict slot, key, counts list).
+
+
+def write_run(buffer, tmp_dir, run_id):
+    run_path = os.path.join(tmp_dir, f"run_{run_id}.tsv")
+    with open(run_path, 'w') as run_file:
+        run_file.writelines(f"{path}\t{c[0]}\t{c[1]}\t{c[2]}\t{c[3]}\n" for path, c in sorted(buffer.items()))
+    return run_path
+
+
+def read_run(run_path):
+    with open(run_path, 'r') as run_file:
+        for line in run_file:
+            path, tot, white, black, draw = line.rstrip("\n").split("\t")
+            yield path, [int(tot), int(white), int(black), int(draw)]
+
+
+def merge_runs(run_paths):
+    # Yields (path, counts) in sorted order, summing equal paths across runs.
+    merged = heapq.merge(*(read_run(run_path) for run_path in run_paths), key=itemgetter(0))
+    cur_path, cur_counts = None, None
+    for path, counts in merged:
+        if path == cur_path:
+            for i in range(4):
+                cur_counts[i] += counts[i]
+        else:
+            if cur_path is not None:
+                yield cur_path, cur_counts
+            cur_path, cur_counts = path, counts
+    if cur_path is not None:
+        yield cur_path, cur_counts
+
+
+def reduce_runs(run_paths, tmp_dir):
+    # Merge groups of MERGE_FAN_IN runs until one final merge can open them all.
+    fan_in = EXT_CFG["MERGE_FAN_IN"]
+    num_pass = 0
+    while len(run_paths) > fan_in:
+        num_pass += 1
+        next_paths = []
+        for i in range(0, len(run_paths), fan_in):
+            group = run_paths[i:i+fan_in]
+            run_path = os.path.join(tmp_dir, f"pass{num_pass}_{i // fan_in}.tsv")
+            with open(run_path, 'w') as run_file:
+                run_file.writelines(f"{path}\t{c[0]}\t{c[1]}\t{c[2]}\t{c[3]}\n" for path, c in merge_runs(group))
+            for old_path in group:
+                os.remove(old_path)
+            next_paths.append(run_path)
+        run_paths = next_paths
+        if DEBUG_MODE:
+            print(cli_util.info(f"Merge pass {num_pass}: {len(run_paths)} runs left."))
+    return run_paths
+
+
+def node_stats(counts, parent_total):
+    # Same fields and rounding as normalize_counts().
+    total = counts[0]
+    stats = {
+        LABELS["TOTAL"]: total,
+        LABELS["WIN-W"]: counts[1],
+        LABELS["WIN-B"]: counts[2],
+        LABELS["DRAW"]: counts[3],
+    }
+    for stat in ["WIN-W", "WIN-B", "DRAW"]:
+        stats[LABELS[stat+"%"]] = round(counts[RESULT_INDEX[stat]] / total, 3)
+    if parent_total is not None:
+        stats[LABELS["MOVE%"]] = round(total / parent_total, 3)
+    return stats
+
+
+def write_tree(merged, stats_path):
+    # Stream the pre-ordered (path, counts) into nested JSON, keeping only the open
+    #  ancestors (at most depth+1) on the stack.
+    totals = []     # Totals of the open nodes, root first.
+    num_nodes = 0
+    with open(stats_path, 'w') as stats_file:
+        for path, counts in merged:
+            moves = path.split(" ") if path else []
+            while len(totals) > len(moves):
+                stats_file.write("}")
+                totals.pop()
+            if len(totals) != len(moves):
+                raise RuntimeError(cli_util.error(f"Merged stream out of order at '{path}'."))
+            stats = ujson.dumps(node_stats(counts, totals[-1] if totals else None))
+            if moves:
+                stats_file.write(f',{ujson.dumps(moves[-1])}:{{"stats":{stats}')
+            else:
+                stats_file.write(f'{{"stats":{stats}')
+            totals.append(counts[0])
+            num_nodes += 1
+        stats_file.write("}" * len(totals))
+    return num_nodes
+
+
+@profiled
+def count_external(rating, sample_path=None, stats_path=None, depth=cfg["STATS_DEPTH"],
+        max_buffer_mb=EXT_CFG["MAX_BUFFER_MB"], group_by=cfg["GROUP_BY"]["ENABLED"]):
+    if sample_path is None:
+        sample_path = build_sample_path(rating)
+    if stats_path is None:
+        stats_path = build_stats_path(rating, depth)
+    max_buffer = max_buffer_mb * (1 << 20)
+    num_games = 0
+    num_read = 0
+    buffer = {}
+    buffer_bytes = 0
+    run_paths = []
+    groups = HeaderGroups() if group_by else None
+
+    tmp_dir = tempfile.mkdtemp(prefix="counts_", dir=EXT_CFG["TMP_DIR"] or None)
+    try:
+        with open_pgn(sample_path) as sample_file:
+            METRICS = metrics.start_metrics("count_external", sample_file,
+                cfg["NUM_EXPECTED_GAMES"]["RATINGS"].get(str(rating)), rating=rating, depth=depth)
+            analyze_sample.METRICS = METRICS    # For has_valid_result().
+            while True:
+                try:
+                    headers = read_headers(sample_file, cond=has_valid_result)
+                except EOFError:
+                    break
+                num_read += 1
+                METRICS.tick(num_read, num_games)
+                if headers == "":   # Game was skipped (invalid result).
+                    continue
+
+                headers = parse_headers(headers)
+                result = get_result(headers)
+                if groups is not None:
+                    groups.add(headers, result)
+                result = RESULT_INDEX[result]
+                moves = parse_game(read_game(sample_file))[:depth]
+                for i in range(len(moves) + 1):
+                    path = " ".join(moves[:i])
+                    counts = buffer.get(path)
+                    if counts is None:
+                        counts = buffer[path] = [0, 0, 0, 0]
+                        buffer_bytes += ENTRY_BYTES + len(path)
+                    counts[0] += 1
+                    counts[result] += 1
+                num_games += 1
+
+                if buffer_bytes >= max_buffer:
+                    run_paths.append(write_run(buffer, tmp_dir, len(run_paths)))
+                    buffer = {}
+                    buffer_bytes = 0
+                    if EXTRA_DEBUG_MODE:
+                        print(cli_util.info(f"Spilled run {len(run_paths)} after {num_games} games."))
+        if buffer:
+            run_paths.append(write_run(buffer, tmp_dir, len(run_paths)))
+            buffer = {}
+        if not run_paths:
+            raise RuntimeError(cli_util.error(f"No games counted from {sample_path}."))
+
+        METRICS.count("spill_runs", len(run_paths))
+        if DEBUG_MODE:
+            print(cli_util.info(f"Merging {len(run_paths)} sorted runs..."))
+        run_paths = reduce_runs(run_paths, tmp_dir)
+        num_nodes = write_tree(merge_runs(run_paths), stats_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if groups is not None:
+        groups.write(build_groups_path(rating))
+    METRICS.finish(num_read, num_games)
+    print(cli_util.success(f"{num_games} games processed. Wrote {num_nodes} nodes to {stats_path}."))
+    return num_games
+
+
+if __name__ == "__main__":
+    rating = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 1200
+    count_external(rating)
@@ -0,0 +1,173 @@
+import sys
+import json
+
+import cli_util
+import dedup
+import metrics
+import sanitize_pgn
+from profiling import profiled
+from prefetch_reader import open_pgn
+from parse_pgn import read_headers, parse_headers, parse_game
+from sanitize_pgn import is_valid_tc, read_game_unsanitized, build_sanitized_path, HEADERS_TO_REMOVE
+from analyze_sample import init_stats_dict, update_dict, normalize_counts, write_stats, build_sample_path
+from eco_groupby import HeaderGroups, build_groups_path
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+FUSED_CFG = cfg["FUSED"]
+ELO_W = cfg["PGN_HEADERS"]["ELO-W"]
+ELO_B = cfg["PGN_HEADERS"]["ELO-B"]
+RESULT = cfg["PGN_HEADERS"]["RESULT"]
+
+'''
+sanitize -> by-elo -> counts in one pass over the source PGN, as chained generators:
+ source games (TC filter, header removal, clock stripping, dedup) -> parsed headers ->
+ Elo buckets -> one counts tree per rating. Only the stats trees are written, unless
+ FUSED.KEEP_INTERMEDIATE also tees the sanitized and by-elo PGNs out along the way.
+Games are filtered and read exactly like the file-based stages, including counting only
+ the last movetext line (what read_game() returns), so the stats come out identical.
+'''
+
+
+def sanitized_games(pgn_file, mode, seen=None):
+    # sanitize_games() without the output file. Yields (headers str, movetext).
+    removed = None
+    while True:
+        if seen is not None:
+            removed = {}
+        try:
+            headers = read_headers(pgn_file, is_valid_tc, HEADERS_TO_REMOVE, removed)
+        except EOFError:
+            return
+        if headers == "":   # Game was skipped.
+            yield None
+            continue
+        movetext = read_game_unsanitized(pgn_file, mode)
+        if seen is not None and seen.add(dedup.game_key(removed, headers, movetext)):
+            sanitize_pgn.METRICS.skip("duplicate")
+            yield None
+            continue
+        yield headers, movetext
+
+
+def tee_games(games, out_path):
+    # Opt-in: write the sanitized stream as sanitize_games() would.
+    batch = []
+    with open(out_path, 'w') as out_file:
+        for game in games:
+            if game is not None:
+                batch.append("\n".join((game[0], game[1], "")))
+                if len(batch) >= cfg["BATCH_SIZE"]:
+                    out_file.write("".join(batch))
+                    batch = []
+            yield game
+        out_file.write("".join(batch))
+
+
+def elo_buckets(headers, ratings):
+    # Ratings whose window holds both players (players_in_rating()); windows may overlap.
+    white_elo = headers.get(ELO_W, "")
+    black_elo = headers.get(ELO_B, "")
+    if not (white_elo.isdigit() and black_elo.isdigit()):
+        return []
+    white_elo, black_elo = int(white_elo), int(black_elo)
+    dev = cfg["RATING_DEV"]
+    return [rating for rating in ratings
+        if rating-dev <= white_elo <= rating+dev and rating-dev <= black_elo <= rating+dev]
+
+
+def last_line(movetext):
+    # What read_game() returns from the written game.
+    return movetext.rstrip("\n").rsplit("\n", 1)[-1] + "\n"
+
+
+@profiled
+def run_fused(pgn_to_use, ratings, mode="ALL", keep_intermediate=FUSED_CFG["KEEP_INTERMEDIATE"], group_by=cfg["GROUP_BY"]["ENABLED"]):
+    # mode "MASTERS": a single MASTERS tree, no Elo filter (Elite DB). Returns {rating: num games}.
+    depth = cfg["STATS_DEPTH"]
+    src_path = cfg["PGN_DIR"] + cfg["SRC_DIR"] + cfg["PGN_FILENAME_SRC"][pgn_to_use]
+    if mode == "MASTERS":
+        ratings = ["MASTERS"]
+    trees = {rating: {"stats": init_stats_dict()} for rating in ratings}
+    counts = {rating: 0 for rating in ratings}
+    groups = {rating: HeaderGroups() for rating in ratings} if group_by else None
+    by_elo_files = {}
+    num_read = 0
+    num_kept = 0
+
+    seen = dedup.open_filter(cfg["PGN_FILENAME_SRC"][pgn_to_use]) if dedup.DEDUP_CFG["ENABLED"] else None
+    with open_pgn(src_path) as pgn_file:
+        METRICS = metrics.start_metrics("run_fused", pgn_file, cfg["NUM_EXPECTED_GAMES"].get(pgn_to_use),
+            source=pgn_to_use, ratings=[str(r) for r in ratings], depth=depth)
+        sanitize_pgn.METRICS = METRICS     # For is_valid_tc().
+        games = sanitized_games(pgn_file, mode, seen)
+        if keep_intermediate:
+            games = tee_games(games, build_sanitized_path(pgn_to_use))
+            if mode != "MASTERS":
+                by_elo_files = {rating: open(build_sample_path(rating), 'w') for rating in ratings}
+
+        try:
+            for game in games:
+                num_read += 1
+                METRICS.tick(num_read, num_kept)
+                if game is None:
+                    continue
+                headers_str, movetext = game
+                headers = parse_headers(headers_str)
+                buckets = ratings if mode == "MASTERS" else elo_buckets(headers, ratings)
+                if not buckets:
+                    METRICS.skip("elo_out_of_range")
+                    continue
+                line = last_line(movetext)
+                for rating in by_elo_files.keys() & buckets:
+                    by_elo_files[rating].write("\n".join((headers_str, line, "")))
+
+                result = headers.get(RESULT)
+                if result not in cfg["RESULTS"]:
+                    METRICS.skip("invalid_result")
+                    continue
+                result = cfg["RESULTS"][result]
+                moves = parse_game(line)[:depth]
+                for rating in buckets:
+                    cur_obj = trees[rating]
+                    update_dict(cur_obj, result)
+                    for move in moves:
+                        if move not in cur_obj:
+                            cur_obj[move] = {"stats": init_stats_dict()}
+                        cur_obj = cur_obj[move]
+                        update_dict(cur_obj, result)
+                    counts[rating] += 1
+                    if groups is not None:
+                        groups[rating].add(headers, result)
+                num_kept += 1
+        finally:
+            for by_elo_file in by_elo_files.values():
+                by_elo_file.close()
+
+    if seen is not None:
+        dedup.save_filter(seen)
+    for rating in ratings:
+        if counts[rating] == 0:
+            print(cli_util.warn(f"No games for {rating}. Not writing stats."))
+            continue
+        write_stats(normalize_counts(trees[rating]), rating)
+        if groups is not None:
+            groups[rating].write(build_groups_path(rating))
+    METRICS.finish(num_read, num_kept)
+    print(cli_util.success(f"Counted {num_kept} of {num_read} games: " +
+        ", ".join(f"{rating}: {counts[rating]}" for rating in ratings)))
+    return counts
+
+
+if __name__ == "__main__":
+    # python fused_pipeline.py [source] [rating]...
+    pgn_to_use = sys.argv[1] if len(sys.argv) > 1 else "ALL"
+    ratings = [int(r) if r.isdigit() else r for r in sys.argv[2:]] or [r for r in cfg["RATINGS"] if r != "MASTERS"]
+    run_fused(pgn_to_use, ratings, mode="MASTERS" if ratings == ["MASTERS"] else "ALL")
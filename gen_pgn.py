@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import random
+import string
+
+import chess
+
+import cli_util
+from parse_pgn import parse_game
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+OPENINGS_JSON = cfg["OPENINGS_JSON"] + cfg["JSON_EXT"]
+SYNTH_CFG = cfg["SYNTHETIC"]
+
+'''
+Synthetic Lichess-style PGN generator, for benchmarking.
+Games are drawn from a pool of legal move sequences: most start with a catalog opening
+ (weighted by how often it is played at 1200), the rest leave book early. Headers, ratings,
+ time controls and %clk comments are randomized per game, so the pool can stay small while
+ the output scales to millions of games.
+'''
+
+# (Event, TimeControl, weight). Bullet and correspondence games get filtered by sanitize_games().
+TIME_CONTROLS = [
+    ("Rated Bullet game", "60+0", 0.15),
+    ("Rated Bullet game", "120+1", 0.05),
+    ("Rated Blitz game", "180+0", 0.25),
+    ("Rated Blitz game", "180+2", 0.10),
+    ("Rated Blitz game", "300+0", 0.15),
+    ("Rated Blitz game", "300+3", 0.10),
+    ("Rated Rapid game", "600+0", 0.10),
+    ("Rated Rapid game", "600+5", 0.04),
+    ("Rated Rapid game", "900+10", 0.03),
+    ("Rated Classical game", "1800+0", 0.02),
+    ("Rated Correspondence game", "-", 0.01),
+]
+RESULT_WEIGHTS = [("1-0", 0.49), ("0-1", 0.46), ("1/2-1/2", 0.045), ("*", 0.005)]
+TERMINATIONS = ["Normal", "Normal", "Normal", "Time forfeit"]
+
+
+def build_synthetic_path(num_games):
+    return os.path.join(cfg["PGN_DIR"], cfg["SRC_DIR"],
+        f'{SYNTH_CFG["PREFIX"]}{num_games}{cfg["PGN_EXT"]}')
+
+
+def load_opening_lines():
+    # (name, ECO-like code, moves, weight) for every catalog line.
+    with open(OPENINGS_JSON, 'r') as openings_file:
+        openings = json.load(openings_file)
+    lines = []
+    for i, (name, opening_obj) in enumerate(openings.items()):
+        if opening_obj["main"] == "[SYSTEM]":
+            continue
+        weight = opening_obj.get("stats_main", {}).get("1200", {}).get("tot", 1)
+        eco = f"{'ABCDE'[i % 5]}{i % 100:02d}"
+        all_lines = [opening_obj["main"]] + opening_obj.get("transpositions", [])
+        for line in all_lines:
+            lines.append((name, eco, parse_game(line), weight / len(all_lines)))
+    return lines
+
+
+def build_pool(rng, pool_size):
+    opening_lines = load_opening_lines()
+    weights = [line[3] for line in opening_lines]
+    pool = []
+    board = chess.Board()
+    for _ in range(pool_size):
+        name, eco, moves, _ = rng.choices(opening_lines, weights)[0]
+        if rng.random() < SYNTH_CFG["OFF_BOOK_RATE"]:
+            moves = moves[:rng.randrange(len(moves))]
+            name, eco = "Unknown Opening", "A00"
+        board.reset()
+        sans = [board.san_and_push(board.parse_san(move)) for move in moves]
+        target_len = rng.randint(SYNTH_CFG["MIN_PLIES"], SYNTH_CFG["MAX_PLIES"])
+        while len(sans) < target_len:
+            legal_moves = list(board.legal_moves)
+            if not legal_moves:
+                break   # Mate or stalemate.
+            sans.append(board.san_and_push(rng.choice(legal_moves)))
+        pool.append((name, eco, sans))
+    return pool
+
+
+def format_clock(seconds):
+    seconds = max(int(seconds), 0)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def format_movetext(rng, sans, time_control, result):
+    if time_control == "-":
+        base, inc = 0, 0
+    else:
+        base, inc = (int(x) for x in time_control.split("+"))
+    clocks = [base, base]
+    tokens = []
+    for ply, san in enumerate(sans):
+        side = ply % 2
+        if ply >= 2:
+            clocks[side] += inc - rng.expovariate(1 / (base / 60 + 1))
+        if base:
+            prefix = f"{ply//2 + 1}. " if side == 0 else f"{ply//2 + 1}... "
+            tokens.append(f"{prefix}{san} {{ [%clk {format_clock(clocks[side])}] }}")
+        else:
+            tokens.append(f"{ply//2 + 1}. {san}" if side == 0 else san)
+    tokens.append(result)
+    return " ".join(tokens)
+
+
+def random_name(rng):
+    return "".join(rng.choices(string.ascii_letters + string.digits, k=rng.randint(5, 14)))
+
+
+def generate_game(rng, pool):
+    name, eco, sans = rng.choice(pool)
+    event, time_control = rng.choices(TIME_CONTROLS, [tc[2] for tc in TIME_CONTROLS])[0][:2]
+    result = rng.choices(RESULT_WEIGHTS, [r[1] for r in RESULT_WEIGHTS])[0][0]
+    elo_w = max(int(rng.gauss(SYNTH_CFG["ELO_MEAN"], SYNTH_CFG["ELO_STD"])), 600)
+    elo_b = max(int(rng.gauss(elo_w, 60)), 600)
+    diff = rng.randint(1, 12)
+    hours, minutes, seconds = rng.randrange(24), rng.randrange(60), rng.randrange(60)
+    date = f"2019.06.{rng.randint(1, 30):02d}"
+    headers = [
+        ("Event", event),
+        ("Site", "https://lichess.org/" + "".join(rng.choices(string.ascii_letters + string.digits, k=8))),
+        ("Date", date),
+        ("Round", "-"),
+        ("White", random_name(rng)),
+        ("Black", random_name(rng)),
+        ("Result", result),
+        ("BlackElo", str(elo_b)),
+        ("BlackRatingDiff", f"{'+' if result == '0-1' else '-'}{diff}"),
+        ("ECO", eco),
+        ("Opening", name),
+        ("Termination", rng.choice(TERMINATIONS)),
+        ("TimeControl", time_control),
+        ("UTCDate", date),
+        ("UTCTime", f"{hours:02d}:{minutes:02d}:{seconds:02d}"),
+        ("WhiteElo", str(elo_w)),
+        ("WhiteRatingDiff", f"{'+' if result == '1-0' else '-'}{diff}"),
+    ]
+    header_str = "".join(f'[{k} "{v}"]\n' for k, v in headers)
+    return f"{header_str}\n{format_movetext(rng, sans, time_control, result)}\n\n"
+
+
+def generate_pgn(num_games, out_path=None, seed=SYNTH_CFG["SEED"]):
+    if out_path is None:
+        out_path = build_synthetic_path(num_games)
+    rng = random.Random(seed)
+    pool = build_pool(rng, SYNTH_CFG["POOL_SIZE"])
+    batch = []
+    with open(out_path, 'w') as out_file:
+        for i in range(num_games):
+            batch.append(generate_game(rng, pool))
+            if len(batch) >= cfg["BATCH_SIZE"]:
+                out_file.write("".join(batch))
+                batch = []
+            if DEBUG_MODE and (i+1) % 1000000 == 0:
+                print(cli_util.info(f"Generated {i+1} / {num_games} games..."))
+        out_file.write("".join(batch))
+    print(cli_util.success(f"Wrote {num_games} synthetic games to {out_path}."))
+    return out_path
+
+
+if __name__ == "__main__":
+    generate_pgn(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
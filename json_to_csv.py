@@ -5,6 +5,7 @@ import csv
 import chess
 
 from cli_util import error, warn, success, info, header, confirm
+from profiling import profiled
 from analyze_opening import get_opening_color
 
 ### CONFIG
@@ -24,6 +25,7 @@ OUT_FILE = cfg["STATS_DIR"] + "openings.csv"
 WR_FILE = cfg["STATS_DIR"] + "winrates.csv"
 
 
+@profiled
 def json_to_csv():
     with open(OPENINGS_JSON, 'r') as openings_file:
         OPENINGS = json.load(openings_file)
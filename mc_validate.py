@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import contextlib
+
+import chess
+import numpy as np
+
+import analyze_sample
+from cli_util import error, warn, success, info
+from analyze_sample import build_stats_path, read_stats, use_stats_dir
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+LABELS = cfg["STAT_LABEL"]
+MC_CFG = cfg["MC_VALIDATE"]
+
+'''
+Monte Carlo check of calc_attainability(): plays the decision trees out move by move and
+ compares the fraction of playouts that reach the end of a line with the analytic value.
+Prevalence: the opening's side plays from the population's move% (p), the opponent plays
+ only moves in the tree, weighted by their p. Attainability: the opponent plays from p,
+ the opening's side follows the best tries (BTL). Leaving the tree ends a playout.
+The trees and best tries are calc_attainability()'s own (build_decision_tree(), calc_att_tree()).
+Every (opening, mode, position) is one row of a transition table; all openings' playouts
+ advance together, one ply per step, as array lookups over the table.
+analyze_opening is imported lazily: it loads STATS_RATING's stats at import, which the
+ self-check does not have.
+'''
+
+SUCCESS, FAIL = 0, 1    # Absorbing rows.
+PREV, ATT = "prev", "att"
+MARKS = ["best_try", "att"]     # Set on the tree by calc_att_tree().
+
+
+def compile_rows(tree_obj, stats_obj, color, mode, depth, rows):
+    # Returns the table row of a decision tree node, rows[row] = (cumulative probs, child rows).
+    #  depth: plies to reach tree_obj. In ATT mode, the tree has calc_att_tree()'s best tries.
+    moves = [move for move in tree_obj if move not in MARKS]
+    if not moves:
+        return SUCCESS
+    child_mover = chess.WHITE if depth % 2 == 0 else chess.BLACK
+
+    if child_mover != color:
+        # Sampled from p; the remaining mass leaves the tree.
+        moves = [move for move in moves if move in stats_obj]
+        probs = [stats_obj[move]["stats"][LABELS["MOVE%"]] for move in moves]
+    elif mode == ATT:
+        if len(moves) > 1:
+            moves = [move for move in moves if tree_obj[move].get("best_try")]
+        moves = [move for move in moves if move in stats_obj]
+        probs = [1.0] * len(moves)
+    else:
+        # Weighted by p among the moves in the tree.
+        moves = [move for move in moves if move in stats_obj]
+        probs = [stats_obj[move]["stats"][LABELS["MOVE%"]] for move in moves]
+        denom = sum(probs)
+        probs = [prob / denom for prob in probs] if denom else []
+
+    if not probs:
+        return FAIL
+    child_rows = [compile_rows(tree_obj[move], stats_obj[move], color, mode, depth + 1, rows)
+        for move in moves]
+    cum = np.cumsum(probs)
+    if child_mover == color:
+        cum[-1] = 1.0   # Never leaves the tree (float error in the normalized sum).
+    rows.append((cum, child_rows))
+    return len(rows) - 1
+
+
+def tree_depth(tree_obj):
+    return max([1 + tree_depth(tree_obj[move]) for move in tree_obj if move not in MARKS] + [0])
+
+
+def build_table(rows):
+    # CUM[row, i] = P(child <= i), padded with inf; CHILD[row, num children] = FAIL (left the tree).
+    max_children = max([len(child_rows) for _, child_rows in rows[2:]] + [1])
+    cum_table = np.full((len(rows), max_children), np.inf)
+    child_table = np.full((len(rows), max_children + 1), FAIL, dtype=np.int64)
+    child_table[SUCCESS, :] = SUCCESS
+    for row, (cum, child_rows) in enumerate(rows[2:], 2):
+        cum_table[row, :len(cum)] = cum
+        child_table[row, :len(child_rows)] = child_rows
+    return cum_table, child_table
+
+
+def simulate(root_rows, cum_table, child_table, num_steps, num_playouts, rng):
+    # Returns the number of playouts from each root that reached the end of a line.
+    hits = np.zeros(len(root_rows), dtype=np.int64)
+    batch = max(1, min(num_playouts, MC_CFG["MAX_BATCH"] // len(root_rows)))
+    roots = np.asarray(root_rows, dtype=np.int64)
+    num_done = 0
+    while num_done < num_playouts:
+        size = min(batch, num_playouts - num_done)
+        states = np.repeat(roots, size)
+        origins = np.repeat(np.arange(len(roots)), size)
+        for _ in range(num_steps):
+            u = rng.random(len(states))
+            k = (u[:, None] >= cum_table[states]).sum(axis=1)
+            states = child_table[states, k]
+            # Drop finished playouts, so later plies only touch the ones still in the tree.
+            hits += np.bincount(origins[states == SUCCESS], minlength=len(roots))
+            alive = states > FAIL
+            states, origins = states[alive], origins[alive]
+            if not len(states):
+                break
+        num_done += size
+    return hits
+
+
+@contextlib.contextmanager
+def catalog(openings, stats):
+    # analyze_opening's globals swapped for openings/stats (calc_attainability() reads them).
+    import analyze_opening
+    prev_openings, prev_stats = analyze_opening.OPENINGS, analyze_opening.STATS
+    analyze_opening.OPENINGS, analyze_opening.STATS = openings, stats
+    try:
+        yield
+    finally:
+        analyze_opening.OPENINGS, analyze_opening.STATS = prev_openings, prev_stats
+
+
+def validate_rating(stats, openings=None, num_playouts=MC_CFG["PLAYOUTS"], rng=None):
+    # Returns {opening: {mode: (analytic, estimate, flagged)}}.
+    import analyze_opening
+    if openings is None:
+        openings = analyze_opening.OPENINGS
+    if rng is None:
+        rng = np.random.default_rng(MC_CFG["SEED"])
+    rows = [None, None]     # SUCCESS, FAIL
+    root_rows = []
+    analytic = []
+    num_steps = 0
+    with catalog(openings, stats):
+        names = [opening for opening, opening_obj in openings.items()
+            if analyze_opening.get_main_line(opening) != "[SYSTEM]" and "transpositions" in opening_obj]
+        for opening in names:
+            opening_color = analyze_opening.get_opening_color(opening)
+            tree_root = analyze_opening.build_decision_tree(opening)
+            # Prevalence first: the att calc marks the best tries on the tree.
+            for mode, color in [(PREV, not opening_color), (ATT, opening_color)]:
+                analytic.append(analyze_opening.calc_att_tree(tree_root, color, mode == PREV))
+                root_rows.append(compile_rows(tree_root, stats, color, mode, 0, rows))
+            num_steps = max(num_steps, tree_depth(tree_root))
+    if not root_rows:
+        return {}
+    cum_table, child_table = build_table(rows)
+    hits = simulate(root_rows, cum_table, child_table, num_steps, num_playouts, rng)
+
+    results = {}
+    for i, opening in enumerate(names):
+        results[opening] = {}
+        for j, mode in enumerate([PREV, ATT]):
+            value = analytic[2*i + j]
+            estimate = hits[2*i + j] / num_playouts
+            std_err = max((value * (1 - value) / num_playouts) ** 0.5, 1 / num_playouts)
+            results[opening][mode] = (value, estimate, abs(estimate - value) > MC_CFG["SIGMAS"] * std_err)
+    return results
+
+
+def validate_all(ratings=cfg["RATINGS"], num_playouts=MC_CFG["PLAYOUTS"]):
+    # True if no opening at any rating is off by more than SIGMAS standard errors.
+    rng = np.random.default_rng(MC_CFG["SEED"])
+    num_flagged = 0
+    for rating in ratings:
+        if not os.path.exists(build_stats_path(rating)):
+            print(warn(f"No stats for {rating}. Skipping..."))
+            continue
+        start = time.perf_counter()
+        results = validate_rating(read_stats(rating), num_playouts=num_playouts, rng=rng)
+        for opening, modes in results.items():
+            for mode, (value, estimate, flagged) in modes.items():
+                if flagged:
+                    num_flagged += 1
+                    print(error(f"[{rating}] {opening} {mode}: analytic {value:.5f}, simulated {estimate:.5f}"))
+                elif EXTRA_DEBUG_MODE:
+                    print(info(f"[{rating}] {opening} {mode}: analytic {value:.5f}, simulated {estimate:.5f}"))
+        if DEBUG_MODE:
+            print(info(f"[{rating}] {len(results)} openings x {num_playouts} playouts "
+                f"in {time.perf_counter() - start:.1f}s."))
+    if num_flagged:
+        print(error(f"{num_flagged} values differ from the simulation."))
+        return False
+    print(success("All openings match the simulation."))
+    return True
+
+
+# Small catalog for self_check(): transpositions that meet in common subtrees, a move
+#  order with no stats, and an opening without transpositions.
+# Stats as (move%, {replies}).
+FIXTURE_TREE = {
+    "d4": (0.45, {
+        "d5": (0.4, {
+            "c4": (0.5, {
+                "e6": (0.3, {"Nc3": (0.6, {"Nf6": (0.7, {}), "Be7": (0.2, {})}), "Nf3": (0.4, {})}),
+                "c6": (0.3, {}),
+                "dxc4": (0.2, {}),
+            }),
+            "Bf4": (0.2, {}),
+            "Nf3": (0.3, {}),
+        }),
+        "Nf6": (0.35, {
+            "c4": (0.6, {
+                "e6": (0.4, {"Nc3": (0.5, {"d5": (0.4, {}), "Bb4": (0.5, {})}), "Nf3": (0.5, {})}),
+                "g6": (0.6, {}),
+            }),
+            "Nf3": (0.3, {}),
+        }),
+        "e6": (0.1, {
+            "c4": (0.5, {"d5": (0.5, {"Nc3": (0.6, {"Nf6": (0.5, {})})}), "Nf6": (0.3, {})}),
+            "e4": (0.4, {}),
+        }),
+    }),
+    "c4": (0.15, {
+        "e6": (0.2, {"d4": (0.4, {"d5": (0.6, {"Nc3": (0.7, {"Nf6": (0.6, {})})})}), "Nc3": (0.3, {})}),
+        "e5": (0.4, {}),
+        "d5": (0.1, {"cxd5": (0.6, {}), "d4": (0.3, {})}),
+    }),
+    "e4": (0.4, {}),
+}
+FIXTURE_OPENINGS = {
+    "Fixture QGD": {
+        "main": "1. d4 d5 2. c4 e6 3. Nc3 Nf6",
+        "transpositions": ["1. d4 Nf6 2. c4 e6 3. Nc3 d5", "1. d4 e6 2. c4 d5 3. Nc3 Nf6",
+            "1. c4 e6 2. d4 d5 3. Nc3 Nf6", "1. c4 e6 2. Nc3 d5 3. d4 Nf6"],
+    },
+    "Fixture QG": {"main": "1. d4 d5 2. c4", "transpositions": ["1. c4 d5 2. d4"]},
+    "Fixture London": {"main": "1. d4 d5 2. Bf4", "transpositions": []},
+}
+
+def fixture_stats(tree=FIXTURE_TREE):
+    return {move: {"stats": {LABELS["MOVE%"]: p}, **fixture_stats(replies)} for move, (p, replies) in tree.items()}
+
+
+def self_check(num_playouts=200000):
+    # Simulation vs. calculation on the fixture catalog, no stats files involved:
+    #  if analyze_opening isn't loaded yet, it loads the fixture's stats from a temp dir.
+    stats = fixture_stats()
+    prev_dir = analyze_sample.cfg["STATS_DIR"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(use_stats_dir(tmp_dir), 'w') as stats_file:
+            json.dump(stats, stats_file)
+        try:
+            import analyze_opening
+        finally:
+            use_stats_dir(prev_dir)
+    results = validate_rating(stats, FIXTURE_OPENINGS, num_playouts)
+    assert set(results) == set(FIXTURE_OPENINGS), results
+    for opening, modes in results.items():
+        for mode, (value, estimate, flagged) in modes.items():
+            assert 0 < value < 1, (opening, mode, value)
+            assert not flagged, (opening, mode, value, estimate)
+    print(success(f"mc_validate self-check passed ({len(results)} openings x {num_playouts} playouts)."))
+
+
+if __name__ == "__main__":
+    if "--self-check" in sys.argv:
+        self_check()
+        sys.exit()
+    # python mc_validate.py [rating]...
+    ratings = [int(r) if r.isdigit() else r for r in sys.argv[1:]] or cfg["RATINGS"]
+    sys.exit(0 if validate_all(ratings) else 1)
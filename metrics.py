@@ -0,0 +1,145 @@
+import os
+import json
+import time
+from collections import Counter
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+METRICS_CFG = cfg["METRICS"]
+ENABLED = METRICS_CFG["ENABLED"] or os.environ.get("PGN_METRICS", "") not in ("", "0")
+
+'''
+Per-run counters and progress for the pipeline stages.
+Stages hold a METRICS global (NULL_METRICS unless enabled), call skip() with the reason a
+ game was dropped and tick() once per game read. tick() is an int compare until the next
+ report is due, and the null version does nothing at all.
+'''
+
+
+def input_position(pgn_file):
+    # Byte offset of a text-mode file without TextIOWrapper.tell()'s slow path.
+    try:
+        return pgn_file.buffer.tell()
+    except (AttributeError, OSError):
+        return pgn_file.tell()
+
+
+class Metrics:
+    def __init__(self, stage, pgn_file=None, num_expected=None, **params):
+        self.stage = stage
+        self.params = params
+        self.pgn_file = pgn_file
+        self.num_expected = num_expected
+        self.size = os.fstat(pgn_file.fileno()).st_size if pgn_file is not None else None
+        self.counters = Counter()
+        self.start = time.time()
+        self.next_report = METRICS_CFG["PROGRESS_EVERY"]
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def skip(self, reason):
+        self.counters["skipped_" + reason] += 1
+
+    def state(self):
+        return dict(self.counters)
+
+    def restore(self, counters):
+        self.counters.update(counters)
+
+    def tick(self, num_read, num_kept):
+        if num_read >= self.next_report:
+            self.next_report += METRICS_CFG["PROGRESS_EVERY"]
+            self.counters["games_read"] = num_read
+            self.counters["games_kept"] = num_kept
+            self.report()
+
+    def bytes_read(self):
+        if self.pgn_file is None or self.pgn_file.closed:
+            return self.size or 0
+        return input_position(self.pgn_file)
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        num_read = self.counters["games_read"]
+        num_bytes = self.bytes_read()
+        msg = (f"[{self.stage}] {num_read} games read, {self.counters['games_kept']} kept "
+            f"({num_read/elapsed:.0f} games/s, {num_bytes/(1 << 20)/elapsed:.1f} MB/s)")
+        # ETA from the expected game count if known, else from bytes left in the file.
+        if self.num_expected:
+            done = num_read / self.num_expected
+        elif self.size:
+            done = num_bytes / self.size
+        else:
+            done = 0
+        if 0 < done < 1:
+            msg += f" {done:.1%}, ETA {time.strftime('%H:%M:%S', time.gmtime(elapsed/done - elapsed))}"
+        print(cli_util.info(msg))
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        counters = dict(self.counters)
+        skipped = sum(v for k, v in counters.items() if k.startswith("skipped_"))
+        other = counters.get("games_read", 0) - counters.get("games_kept", 0) - skipped
+        if other > 0:
+            counters["skipped_other"] = other
+        return {
+            "stage": self.stage,
+            "params": self.params,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+            "seconds": round(elapsed, 3),
+            "bytes_read": self.bytes_read(),
+            "num_expected": self.num_expected,
+            "counters": counters,
+        }
+
+    def finish(self, num_read, num_kept):
+        self.counters["games_read"] = num_read
+        self.counters["games_kept"] = num_kept
+        summary = self.summary()
+        os.makedirs(METRICS_CFG["DIR"], exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.start))
+        out_path = os.path.join(METRICS_CFG["DIR"], f"{self.stage}_{stamp}{cfg['JSON_EXT']}")
+        with open(out_path, 'w') as out_file:
+            json.dump(summary, out_file, indent=4)
+        if DEBUG_MODE:
+            print(cli_util.success(f"Wrote metrics to {out_path}."))
+        return summary
+
+
+class NullMetrics:
+    def count(self, name, n=1):
+        pass
+
+    def skip(self, reason):
+        pass
+
+    def state(self):
+        return {}
+
+    def restore(self, counters):
+        pass
+
+    def tick(self, num_read, num_kept):
+        pass
+
+    def finish(self, num_read, num_kept):
+        return None
+
+
+NULL_METRICS = NullMetrics()
+
+
+def start_metrics(stage, pgn_file=None, num_expected=None, **params):
+    if not ENABLED:
+        return NULL_METRICS
+    return Metrics(stage, pgn_file, num_expected, **params)
@@ -34,10 +34,11 @@ def parse_headers(headers):
 def default_true(name, value):
     return True
 
-def read_headers(pgn_file, cond=default_true, headers_to_remove=None):
+def read_headers(pgn_file, cond=default_true, headers_to_remove=None, removed=None):
     # If game is valid according to cond, return str of headers.
     # Otherwise, if the game may be followed by more games, return empty string.
     # cond should return: -1 for invalid, 1 for valid, 0 for currently unsure.
+    # If removed is a dict, the values of removed headers are stored in it.
     if headers_to_remove is None:
         headers_to_remove = []
     cond_fulfilled = False
@@ -60,6 +61,8 @@ def read_headers(pgn_file, cond=default_true, headers_to_remove=None):
             parsed = parse_header(line)
             name, value = parsed
             if name in headers_to_remove:
+                if removed is not None:
+                    removed[name] = value
                 continue
             ret = cond(name, value)
             if ret < 0:
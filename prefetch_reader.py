@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import threading
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+PREFETCH_CFG = cfg["PREFETCH"]
+
+'''
+Input PGN file with a background thread that reads ahead of the stage, so disk reads
+ overlap with parsing instead of alternating with it.
+The stage reads through a normal text file (readline(), tell(), seek() are the built-in
+ ones, at full speed). The thread keeps the next NUM_BUFFERS blocks of BLOCK_MB in the page
+ cache, following the stage's position (and its seeks), and waits when it is that far
+ ahead. With FADVISE it asks the kernel to read each block (POSIX_FADV_WILLNEED, no copy
+ through Python) and marks the file as sequential; otherwise it pread()s the block itself,
+ which releases the GIL while waiting on the disk.
+(Splitting blocks into lines in Python measured slower than the C readline(), so the
+ thread only moves data from disk into the cache.)
+'''
+
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+POLL_SECONDS = 0.002
+
+
+class PrefetchReader:
+    def __init__(self, path, block_size=PREFETCH_CFG["BLOCK_MB"] << 20, num_buffers=PREFETCH_CFG["NUM_BUFFERS"],
+            fadvise=PREFETCH_CFG["FADVISE"]):
+        self.file = open(path, 'r')
+        self.name = path
+        self.buffer = self.file.buffer
+        # Bound directly, so reads cost the same as on the plain file.
+        self.readline = self.file.readline
+        self.tell = self.file.tell
+        self.seek = self.file.seek
+        self.fileno = self.file.fileno
+
+        self.block_size = block_size
+        self.window = block_size * num_buffers
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.fadvise = fadvise and HAS_FADVISE
+        if self.fadvise:
+            os.posix_fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def _read_ahead(self):
+        # Reads on its own descriptor. The stage's position is its descriptor's offset
+        #  (lseek() doesn't touch the file object's buffer or lock).
+        stage_fd = self.file.fileno()
+        fd = os.open(self.name, os.O_RDONLY)
+        block = None if self.fadvise else bytearray(self.block_size)
+        ahead = 0
+        try:
+            while not self.stop.is_set():
+                pos = os.lseek(stage_fd, 0, os.SEEK_CUR)
+                if ahead < pos or ahead > pos + self.window + self.block_size:
+                    ahead = pos     # Started, or the stage seeked.
+                if ahead >= self.size or ahead - pos >= self.window:
+                    self.stop.wait(POLL_SECONDS)
+                    continue
+                if self.fadvise:
+                    # Kernel readahead of the block: no copy through this process.
+                    os.posix_fadvise(fd, ahead, self.block_size, os.POSIX_FADV_WILLNEED)
+                    ahead += self.block_size
+                else:
+                    ahead += os.preadv(fd, [block], ahead) or self.block_size
+        except OSError as e:
+            if DEBUG_MODE:
+                print(cli_util.warn(f"Prefetching {self.name} stopped: {e}"))
+        finally:
+            os.close(fd)
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        if not self.file.closed:
+            self.stop.set()
+            self.thread.join()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_pgn(path, prefetch=PREFETCH_CFG["ENABLED"]):
+    # Input PGNs for the pipeline stages.
+    if prefetch:
+        return PrefetchReader(path)
+    return open(path, 'r')
+
+
+def drop_cache(path):
+    # Evict the file from the page cache (as far as the kernel allows), for cold-cache timings.
+    if not HAS_FADVISE:
+        print(cli_util.warn("posix_fadvise() not available: timings are with a warm cache."))
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def time_parse(path, prefetch):
+    # Headers + movetext of every game, as the stages read them.
+    from parse_pgn import read_headers, read_game
+    drop_cache(path)
+    num_games = 0
+    start = time.perf_counter()
+    with open_pgn(path, prefetch) as pgn_file:
+        while True:
+            try:
+                read_headers(pgn_file)
+            except EOFError:
+                break
+            read_game(pgn_file)
+            num_games += 1
+    return time.perf_counter() - start, num_games
+
+
+if __name__ == "__main__":
+    # python prefetch_reader.py <pgn>: cold-cache parse throughput with and without prefetching.
+    path = sys.argv[1]
+    size_mb = os.path.getsize(path) / (1 << 20)
+    drop_cache(path)
+    start = time.perf_counter()
+    with open(path, 'rb') as raw_file:
+        while raw_file.read(PREFETCH_CFG["BLOCK_MB"] << 20):
+            pass
+    print(cli_util.info(f"disk only   : {size_mb / (time.perf_counter() - start):.1f} MB/s "
+        "(prefetching can only help if this is not much faster than parsing)"))
+    for prefetch in [False, True]:
+        elapsed, num_games = time_parse(path, prefetch)
+        print(cli_util.info(f"prefetch {'on ' if prefetch else 'off'}: {num_games} games, "
+            f"{elapsed:.2f}s, {size_mb / elapsed:.1f} MB/s"))
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import functools
+import tracemalloc
+
+import cli_util
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+PROFILE_CFG = cfg["PROFILE"]
+
+# PGN_PROFILE=cpu, =mem or =cpu,mem overrides the config for one run.
+_env = {mode.strip().lower() for mode in os.environ.get("PGN_PROFILE", "").split(",") if mode.strip()}
+PROFILE_CPU = PROFILE_CFG["CPU"] or "cpu" in _env
+PROFILE_MEMORY = PROFILE_CFG["MEMORY"] or "mem" in _env
+
+_ACTIVE = False     # Only the outermost profiled stage records (e.g. write_stats inside a runner).
+
+
+def write_cpu_report(profiler, out_base):
+    profiler.dump_stats(out_base + ".prof")
+    with open(out_base + "_cpu.txt", 'w') as report_file:
+        stats = pstats.Stats(profiler, stream=report_file)
+        stats.sort_stats("cumulative").print_stats(PROFILE_CFG["TOP_N"])
+        stats.sort_stats("tottime").print_stats(PROFILE_CFG["TOP_N"])
+
+
+def write_memory_report(snapshot, peak, out_base):
+    with open(out_base + "_alloc.txt", 'w') as report_file:
+        report_file.write(f"Peak traced memory: {peak / (1 << 20):.1f} MB\n\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_CFG["TOP_N"]]:
+            report_file.write(f"{stat}\n")
+
+
+def profiled(func):
+    # Decorate a pipeline stage to write profiles/<stage>_<time>{.prof,_cpu.txt,_alloc.txt}.
+    # Decided at import time: with profiling off the stage is returned untouched.
+    if not (PROFILE_CPU or PROFILE_MEMORY):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _ACTIVE
+        if _ACTIVE:
+            return func(*args, **kwargs)
+        _ACTIVE = True
+        os.makedirs(PROFILE_CFG["DIR"], exist_ok=True)
+        out_base = os.path.join(PROFILE_CFG["DIR"], f"{func.__name__}_{time.strftime('%Y%m%d-%H%M%S')}")
+
+        if PROFILE_MEMORY:
+            tracemalloc.start(PROFILE_CFG["TRACEMALLOC_FRAMES"])
+        profiler = cProfile.Profile() if PROFILE_CPU else None
+        try:
+            if profiler is not None:
+                return profiler.runcall(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                write_cpu_report(profiler, out_base)
+            if PROFILE_MEMORY:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                write_memory_report(snapshot, peak, out_base)
+            _ACTIVE = False
+            print(cli_util.info(f"Wrote profile for {func.__name__} to {out_base}*."))
+
+    return wrapper
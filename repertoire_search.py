@@ -0,0 +1,214 @@
+import os
+import json
+import heapq
+import argparse
+
+import chess
+
+from cli_util import warn, success, info, header
+from parse_pgn import game_to_pgn
+from analyze_sample import read_stats
+from analyze_opening import generate_BTL
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+LABELS = cfg["STAT_LABEL"]
+SEARCH_CFG = cfg["REPERTOIRE_SEARCH"]
+
+'''
+Top-K search for lines worth playing, over the whole stats tree instead of openings.json.
+A candidate is a position reached by one of our own moves, at least MIN_DEPTH plies in
+ (attainability only shrinks as a line gets longer, so without it the top K is all first
+ moves). All move orders in the tree that reach it are its transpositions, and its
+ attainability is computed exactly like calc_attainability(): max over our moves, sum over
+ the opponent's, times their MOVE%.
+The tree is walked in full (down to max_depth, through nodes with at least MIN_GAMES), so
+ every move order of every candidate is known and the top K is exact. Only the scoring is
+ cut short: att <= the sum over its move orders of the opponent's MOVE% product, so
+ candidates are scored in decreasing order of that bound until it drops below the K-th best.
+The walk is not pruned: a subtree below the K-th best can still hold another move order
+ of a candidate above it. It costs ~25-35us per node, mostly push_san() (positions are
+ keyed on the board's bitboards: epd() cost another ~60us per candidate). Each depth holds
+ at most games / MIN_GAMES nodes, so a walk is at most depth * games / MIN_GAMES nodes:
+ 10 * 2.1M / 20 ~ 1M (~30s) for a month of 1200 games at depth 10.
+'''
+
+# score(att, own win rate, draw rate). Must be increasing in att for the bound above to hold.
+SCORES = {
+    "ATTAIN": lambda att, win, draw: att,
+    "ATT_X_WINRATE": lambda att, win, draw: att * win,
+    "ATT_X_POINTS": lambda att, win, draw: att * (win + draw/2),
+}
+
+
+def line_attainability(paths, stats_root, color):
+    # Same rules as calc_att_inner() in att mode, over the decision tree of paths.
+    # Leaves "best_try"/"att" marks in the returned tree for generate_BTL().
+    tree_root = {}
+    for moves in paths:
+        cur_obj = tree_root
+        for move in moves:
+            cur_obj = cur_obj.setdefault(move, {})
+
+    def att_inner(tree_obj, stats_obj, cur_color):
+        att = 1
+        if tree_obj:
+            atts = {move: att_inner(tree_obj[move], stats_obj[move], not cur_color) for move in tree_obj}
+            if cur_color == color:
+                att = sum(atts.values())
+            else:
+                move_max = max(atts, key=atts.get)
+                att = atts[move_max]
+                if len(atts) > 1:
+                    tree_obj[move_max]["best_try"] = True
+                    tree_obj[move_max]["att"] = att
+        if cur_color != color and tree_obj is not tree_root:
+            att *= stats_obj["stats"][LABELS["MOVE%"]]
+        return att
+
+    # Root = Black, so that first move flips to White.
+    return att_inner(tree_root, stats_root, chess.BLACK), tree_root
+
+
+def position_key(board):
+    # Same position as board.epd() (en passant only if legal), without building the string.
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+        board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK], board.turn,
+        board.clean_castling_rights(), board.ep_square if board.has_legal_en_passant() else None)
+
+
+def collect_positions(color, stats_root, min_games, min_depth, max_depth):
+    # Position key -> {"paths": [(q, moves)], "tot", "win", "draw"} for every candidate, where q is
+    #  the product of the opponent's MOVE% along the path. Returns (positions, nodes visited).
+    own_label = LABELS["WIN-W"] if color == chess.WHITE else LABELS["WIN-B"]
+    positions = {}
+    board = chess.Board()
+    moves = []
+    num_nodes = 0
+
+    def visit(stats_obj, q):
+        nonlocal num_nodes
+        num_nodes += 1
+        ply = len(moves)
+        # Last move was ours: this position is a candidate (possibly via another move order).
+        if ply >= max(min_depth, 1) and (ply % 2 == 1) == (color == chess.WHITE):
+            pos = positions.setdefault(position_key(board), {"paths": [], "tot": 0, "win": 0, "draw": 0})
+            stats = stats_obj["stats"]
+            pos["paths"].append((q, tuple(moves)))
+            pos["tot"] += stats[LABELS["TOTAL"]]
+            pos["win"] += stats[own_label]
+            pos["draw"] += stats[LABELS["DRAW"]]
+
+        if max_depth is not None and ply >= max_depth:
+            return
+        opp_to_move = (board.turn != color)
+        for move, child in stats_obj.items():
+            if move == "stats" or child["stats"][LABELS["TOTAL"]] < min_games:
+                continue
+            q_child = q * child["stats"][LABELS["MOVE%"]] if opp_to_move else q
+            if q_child <= 0:
+                continue
+            try:
+                board.push_san(move)
+            except ValueError:
+                if EXTRA_DEBUG_MODE:
+                    print(warn(f"Skipping non-SAN node '{move}' after {game_to_pgn(moves)}."))
+                continue
+            moves.append(move)
+            visit(child, q_child)
+            moves.pop()
+            board.pop()
+
+    visit(stats_root, 1.0)
+    return positions, num_nodes
+
+
+def search_repertoire(color, stats_root, k=SEARCH_CFG["TOP_K"], score=SEARCH_CFG["SCORE"],
+        min_games=SEARCH_CFG["MIN_GAMES"], min_depth=SEARCH_CFG["MIN_DEPTH"], max_depth=None):
+    score_func = SCORES[score]
+    positions, num_nodes = collect_positions(color, stats_root, min_games, min_depth, max_depth)
+
+    def position_score(pos, att):
+        return score_func(att, pos["win"] / pos["tot"], pos["draw"] / pos["tot"])
+
+    # Upper bounds first: one move order's att is its q, and several orders' att is at most the sum.
+    bounds = sorted(((position_score(pos, sum(q for q, _ in pos["paths"])), key)
+        for key, pos in positions.items()), reverse=True)
+    top = []    # Min-heap of (score, key), the best K so far.
+    num_scored = 0
+    for bound, key in bounds:
+        if len(top) >= k and bound < top[0][0]:
+            break
+        pos = positions[key]
+        if len(pos["paths"]) == 1:
+            value = bound
+        else:
+            att, _ = line_attainability([m for _, m in pos["paths"]], stats_root, color)
+            value = position_score(pos, att)
+        num_scored += 1
+        if len(top) < k:
+            heapq.heappush(top, (value, key))
+        elif value > top[0][0]:
+            heapq.heapreplace(top, (value, key))
+
+    if DEBUG_MODE:
+        print(info(f"Visited {num_nodes} nodes, {len(positions)} candidate positions, scored {num_scored}."))
+
+    results = []
+    for value, key in sorted(top, reverse=True):
+        pos = positions[key]
+        paths = [m for _, m in pos["paths"]]
+        att, tree_root = line_attainability(paths, stats_root, color)
+        main_line = game_to_pgn(max(pos["paths"])[1])
+        results.append({
+            "line": main_line,
+            "score": round(value, 4),
+            LABELS["ATTAIN"]: round(att, 4),
+            "win_p": round(pos["win"] / pos["tot"], 3),
+            LABELS["DRAW%"]: round(pos["draw"] / pos["tot"], 3),
+            LABELS["TOTAL"]: pos["tot"],
+            "move_orders": len(paths),
+            "BTL": generate_BTL(main_line, tree_root, color, color),
+        })
+    return results
+
+
+def build_search_path(color, rating):
+    color_name = "White" if color == chess.WHITE else "Black"
+    return os.path.join(cfg["STATS_DIR"], f"repertoire_{color_name}_{rating}{cfg['JSON_EXT']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Top-K lines by attainability-based score.")
+    parser.add_argument("--color", choices=["white", "black"], default="white")
+    parser.add_argument("--rating", default=cfg["STATS_RATING"])
+    parser.add_argument("--k", type=int, default=SEARCH_CFG["TOP_K"])
+    parser.add_argument("--score", choices=list(SCORES), default=SEARCH_CFG["SCORE"])
+    parser.add_argument("--min-games", type=int, default=SEARCH_CFG["MIN_GAMES"])
+    parser.add_argument("--min-depth", type=int, default=SEARCH_CFG["MIN_DEPTH"], help="Min plies of a line.")
+    parser.add_argument("--depth", type=int, default=None, help="Max plies (default: whole tree).")
+    args = parser.parse_args()
+
+    color = chess.WHITE if args.color == "white" else chess.BLACK
+    results = search_repertoire(color, read_stats(args.rating), args.k, args.score, args.min_games,
+        args.min_depth, args.depth)
+    if not results:
+        print(warn("No lines found. Try a lower --min-games."))
+    for i, result in enumerate(results, 1):
+        print(header(f"{i:>3}. {result['line']}"))
+        print(f"     score {result['score']}, att {result[LABELS['ATTAIN']]}, win {result['win_p']}, "
+            f"draw {result[LABELS['DRAW%']]}, {result[LABELS['TOTAL']]} games, {result['move_orders']} move order(s)")
+        if result["move_orders"] > 1:
+            print(f"     BTL: {result['BTL']}")
+
+    out_path = build_search_path(color, args.rating)
+    with open(out_path, 'w') as out_file:
+        json.dump(results, out_file, indent=4)
+    print(success(f"Wrote {len(results)} lines to {out_path}."))
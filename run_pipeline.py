@@ -0,0 +1,289 @@
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import cli_util
+import checkpoint
+from sanitize_pgn import build_sanitized_path
+from analyze_sample import build_sample_path, build_stats_path
+from clock_sidecar import build_clock_path, build_think_times_path
+from eco_groupby import build_groups_path
+
+### CONFIG
+try:
+    with open("config.json") as cfg_file:
+        cfg = json.load(cfg_file)
+except:
+    raise OSError("ERROR: Cannot find/parse config file.")
+
+DEBUG_MODE = cfg["DEBUG_MODE"]
+EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
+OPENINGS_JSON = cfg["OPENINGS_JSON"] + cfg["JSON_EXT"]
+PIPELINE_CFG = cfg["PIPELINE"]
+
+'''
+Runs sanitize -> by-elo -> counts -> opening stats -> CSV as a DAG.
+Each stage is keyed on the fingerprints (size, mtime) of its input files plus the
+ config.json keys it reads. The manifest records that key and the fingerprints of the
+ outputs; a stage reruns only if the key changed or an output is missing/modified.
+ Rerunning a stage rewrites its outputs, so everything downstream goes stale with it.
+Independent stages (by-elo + counts per rating) run in parallel worker processes.
+MASTERS skips by-elo: its counts are taken from the sanitized Elite DB directly.
+With FUSED.ENABLED, sanitize + by-elo + counts are one "fused:<source>" stage per source
+ (fused_pipeline.py), which reads the source PGN once and writes only the stats.
+'''
+
+
+### STAGES
+# Run in spawned workers, so module globals (CUR_RATING, OPENINGS, ...) start fresh.
+
+def run_sanitize(pgn_to_use, mode, out_path, resume):
+    from sanitize_pgn import sanitize_games
+    from prefetch_reader import open_pgn
+    src_path = cfg["PGN_DIR"] + cfg["SRC_DIR"] + cfg["PGN_FILENAME_SRC"][pgn_to_use]
+    with open_pgn(src_path) as pgn_file:
+        sanitize_games(pgn_file, out_path=out_path, mode=mode,
+            num_expected=cfg["NUM_EXPECTED_GAMES"].get(pgn_to_use), resume=resume)
+
+def run_fused(pgn_to_use, ratings, mode):
+    from fused_pipeline import run_fused
+    run_fused(pgn_to_use, ratings, mode=mode)
+
+def run_separate(rating, pgn_path, out_path):
+    from sample_by_elo import separate_by_elo
+    separate_by_elo(rating, pgn_path=pgn_path, out_path=out_path)
+
+def run_counts(rating, sample_path, resume):
+    if cfg["EXTERNAL_COUNTS"]["ENABLED"]:
+        from external_counts import count_external
+        count_external(rating, sample_path=sample_path)
+        return
+    from analyze_sample import get_counts_by_rating, normalize_counts, write_stats
+    root_obj = get_counts_by_rating(rating, sample_path=sample_path, resume=resume)
+    write_stats(normalize_counts(root_obj), rating)
+
+def run_openings(ratings):
+    import analyze_opening
+    from analyze_sample import read_stats
+    for rating in ratings:
+        analyze_opening.RATING = rating
+        analyze_opening.STATS = read_stats(rating)
+        analyze_opening.process_all_openings(analyze_opening.update_opening, write=False)
+    analyze_opening.write_opening_stats(ask=False)
+
+def run_csv():
+    from json_to_csv import json_to_csv, split_wr_rating
+    json_to_csv()
+    split_wr_rating()
+
+
+def opening_lines_digest():
+    # Only the lines feed the stats; the stats fields are this stage's own output.
+    with open(OPENINGS_JSON, 'r') as openings_file:
+        openings = json.load(openings_file)
+    lines = {name: [obj.get("main"), obj.get("main_real"), obj.get("transpositions")]
+        for name, obj in openings.items()}
+    return hashlib.sha1(json.dumps(lines, sort_keys=True).encode()).hexdigest()
+
+
+def clock_paths(pgn_path):
+    # <pgn>.clk next to a PGN, if CLOCKS is on.
+    return [build_clock_path(pgn_path)] if cfg["CLOCKS"]["ENABLED"] else []
+
+def think_times_paths(rating):
+    return [build_think_times_path(rating)] if cfg["CLOCKS"]["ENABLED"] else []
+
+def groups_paths(names):
+    # stats/<name>_groups.json per rating (or sanitized PGN), if GROUP_BY is on.
+    return [build_groups_path(name) for name in names] if cfg["GROUP_BY"]["ENABLED"] else []
+
+
+def make_stage(name, func, args, deps, inputs, outputs, config_keys, extra=None):
+    return {
+        "name": name,
+        "func": func,
+        "args": args,
+        "deps": deps,
+        "inputs": inputs,
+        "outputs": outputs,
+        "config_keys": config_keys,
+        "extra": extra,     # Callable for inputs that are not whole files.
+    }
+
+
+def build_stages(ratings, resume=False):
+    # Returned in topological order.
+    stages = {}
+    num_ratings = [r for r in ratings if str(r) != "MASTERS"]
+    sources = []
+    if num_ratings:
+        sources.append((PIPELINE_CFG["SOURCE"], "ALL"))
+    if len(num_ratings) < len(ratings):
+        sources.append((PIPELINE_CFG["MASTERS_SOURCE"], "MASTERS"))
+
+    if cfg["FUSED"]["ENABLED"]:
+        counts_stages = {}
+        for pgn_to_use, mode in sources:
+            src_path = cfg["PGN_DIR"] + cfg["SRC_DIR"] + cfg["PGN_FILENAME_SRC"][pgn_to_use]
+            src_ratings = ["MASTERS"] if mode == "MASTERS" else num_ratings
+            name = f"fused:{pgn_to_use}"
+            stages[name] = make_stage(name, run_fused, (pgn_to_use, src_ratings, mode),
+                [], [src_path], [build_stats_path(rating) for rating in src_ratings] + groups_paths(src_ratings),
+                ["TC", "DEDUP", "RATING_DEV", "STATS_DEPTH", "STAT_LABEL", "RESULTS", "PGN_HEADERS", "GROUP_BY"],
+                extra=lambda mode=mode, src_ratings=src_ratings: [mode] + [str(r) for r in src_ratings])
+            counts_stages.update({rating: name for rating in src_ratings})
+        return build_final_stages(stages, ratings, [counts_stages[rating] for rating in ratings])
+
+    sanitized = {}
+    for pgn_to_use, mode in sources:
+        src_path = cfg["PGN_DIR"] + cfg["SRC_DIR"] + cfg["PGN_FILENAME_SRC"][pgn_to_use]
+        sanitized[mode] = build_sanitized_path(pgn_to_use)
+        name = f"sanitize:{pgn_to_use}"
+        stages[name] = make_stage(name, run_sanitize, (pgn_to_use, mode, sanitized[mode], resume),
+            [], [src_path], [sanitized[mode]] + clock_paths(sanitized[mode])
+                + groups_paths([os.path.splitext(os.path.basename(sanitized[mode]))[0]]),
+            ["TC", "DEDUP", "PGN_HEADERS", "CLOCKS", "GROUP_BY"], extra=lambda mode=mode: mode)
+
+    sanitize_all = f"sanitize:{PIPELINE_CFG['SOURCE']}"
+    for rating in ratings:
+        if str(rating) == "MASTERS":
+            sample_path = sanitized["MASTERS"]
+            counts_deps = [f"sanitize:{PIPELINE_CFG['MASTERS_SOURCE']}"]
+        else:
+            sample_path = build_sample_path(rating)
+            name = f"by_elo:{rating}"
+            stages[name] = make_stage(name, run_separate, (rating, sanitized["ALL"], sample_path),
+                [sanitize_all], [sanitized["ALL"]] + clock_paths(sanitized["ALL"]),
+                [sample_path] + clock_paths(sample_path), ["RATING_DEV", "PGN_HEADERS", "CLOCKS"],
+                extra=lambda rating=rating: str(rating))
+            counts_deps = [name]
+        name = f"counts:{rating}"
+        stages[name] = make_stage(name, run_counts, (rating, sample_path, resume),
+            counts_deps, [sample_path] + clock_paths(sample_path),
+            [build_stats_path(rating)] + think_times_paths(rating) + groups_paths([rating]),
+            ["STATS_DEPTH", "STAT_LABEL", "RESULTS", "PGN_HEADERS", "CLOCKS", "GROUP_BY"])
+    return build_final_stages(stages, ratings, [f"counts:{rating}" for rating in ratings])
+
+
+def build_final_stages(stages, ratings, counts_deps):
+    stats_paths = [build_stats_path(rating) for rating in ratings]
+    stages["openings"] = make_stage("openings", run_openings, (ratings,),
+        sorted(set(counts_deps)), stats_paths, [OPENINGS_JSON],
+        ["STAT_LABEL"], extra=opening_lines_digest)
+    stages["csv"] = make_stage("csv", run_csv, (), ["openings"], [OPENINGS_JSON],
+        [cfg["STATS_DIR"] + "openings.csv", cfg["STATS_DIR"] + "winrates.csv"], ["RATINGS", "STAT_LABEL"])
+    return stages
+
+
+### MANIFEST
+
+def read_manifest():
+    if not os.path.exists(PIPELINE_CFG["MANIFEST"]):
+        return {}
+    with open(PIPELINE_CFG["MANIFEST"], 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def write_manifest(manifest):
+    tmp_path = PIPELINE_CFG["MANIFEST"] + ".tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, PIPELINE_CFG["MANIFEST"])
+
+
+def fingerprint_or_none(path):
+    return checkpoint.fingerprint(path) if os.path.exists(path) else None
+
+def stage_key(stage):
+    key_obj = {
+        "inputs": [fingerprint_or_none(path) for path in stage["inputs"]],
+        "config": {k: cfg[k] for k in stage["config_keys"]},
+        "extra": stage["extra"]() if stage["extra"] else None,
+    }
+    return hashlib.sha1(json.dumps(key_obj, sort_keys=True).encode()).hexdigest()
+
+def is_up_to_date(manifest, stage, key):
+    entry = manifest.get(stage["name"])
+    if entry is None or entry["key"] != key:
+        return False
+    return all(fingerprint_or_none(path) == entry["outputs"].get(path) for path in stage["outputs"])
+
+
+### RUNNER
+
+def run_pipeline(ratings=cfg["RATINGS"], force=False, dry_run=False, resume=False):
+    stages = build_stages(ratings, resume)
+    manifest = read_manifest()
+    done, rerun, failed = set(), set(), set()
+    pending = dict(stages)
+    running = {}
+    num_workers = PIPELINE_CFG["WORKERS"] or os.cpu_count()
+
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dep in failed for dep in stage["deps"]):
+                    print(cli_util.warn(f"[{name}] Skipped: an upstream stage failed."))
+                    failed.add(name)
+                    del pending[name]
+                    continue
+                if not all(dep in done for dep in stage["deps"]):
+                    continue
+                del pending[name]
+
+                key = stage_key(stage)
+                stale = force or any(dep in rerun for dep in stage["deps"]) or not is_up_to_date(manifest, stage, key)
+                if not stale:
+                    if DEBUG_MODE:
+                        print(cli_util.info(f"[{name}] Up to date."))
+                    done.add(name)
+                    continue
+                rerun.add(name)
+                if dry_run:
+                    print(cli_util.header(f"[{name}] Would run."))
+                    done.add(name)
+                    continue
+                print(cli_util.header(f"[{name}] Running..."))
+                running[pool.submit(stage["func"], *stage["args"])] = (stage, key)
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    print(cli_util.error(f"[{stage['name']}] Failed: {e!r}"))
+                    failed.add(stage["name"])
+                    continue
+                # Key taken before the run: inputs changed meanwhile will trigger a rerun next time.
+                manifest[stage["name"]] = {
+                    "key": key,
+                    "outputs": {path: fingerprint_or_none(path) for path in stage["outputs"]},
+                }
+                write_manifest(manifest)
+                done.add(stage["name"])
+                print(cli_util.success(f"[{stage['name']}] Done."))
+
+    if failed:
+        print(cli_util.error(f"{len(failed)} stage(s) failed or skipped: {', '.join(sorted(failed))}"))
+    print(cli_util.success(f"Pipeline finished: {len(rerun - failed)} stage(s) {'to run' if dry_run else 'run'}, "
+        f"{len(done - rerun)} up to date."))
+    return not failed
+
+
+def parse_rating(rating):
+    return int(rating) if rating.isdigit() else rating
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline, skipping up-to-date stages.")
+    parser.add_argument("--ratings", nargs="+", type=parse_rating, default=cfg["RATINGS"])
+    parser.add_argument("--force", action="store_true", help="Rerun every stage.")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the stages that would run.")
+    parser.add_argument("--resume", action="store_true", help="Resume sanitize/counts from checkpoints.")
+    args = parser.parse_args()
+    run_pipeline(args.ratings, args.force, args.dry_run, args.resume)
@@ -3,6 +3,10 @@ import json
 import random
 
 import cli_util
+import metrics
+import clock_sidecar
+from profiling import profiled
+from prefetch_reader import open_pgn
 
 from parse_pgn import read_headers, read_game, skip_game
 
@@ -25,13 +29,14 @@ MODE_TO_USE = "ALL" # "MASTERS" or "ALL"
 
 FIRST_PLAYER_VALID = False  # Must reset to False after each game.
 CUR_RATING = 0
+METRICS = metrics.NULL_METRICS
 
 
 def players_in_rating(name, value):
     global FIRST_PLAYER_VALID, CUR_RATING
     if name in (cfg["PGN_HEADERS"]["ELO-W"], cfg["PGN_HEADERS"]["ELO-B"]):
         if value.isdigit() and CUR_RATING-cfg["RATING_DEV"] <= int(value) <= CUR_RATING+cfg["RATING_DEV"]:
-            if cfg["DEBUG_MODE"]:
+            if EXTRA_DEBUG_MODE:
                 print(cli_util.info(f"elo within range: {value}"))
             if FIRST_PLAYER_VALID:
                 FIRST_PLAYER_VALID = False
@@ -39,22 +44,31 @@ def players_in_rating(name, value):
             FIRST_PLAYER_VALID = True
             return 0
         FIRST_PLAYER_VALID = False
+        METRICS.skip("elo_out_of_range" if value.isdigit() else "unrated")
         return -1
     return 0
 
 
-def separate_by_elo(rating):
+@profiled
+def separate_by_elo(rating, pgn_path=PGN_PATH, out_path=None, keep_clocks=cfg["CLOCKS"]["ENABLED"]):
     # Create a new pgn file for specified elo.
     # sanitized --> by-elo
-    global FIRST_PLAYER_VALID, CUR_RATING
+    global FIRST_PLAYER_VALID, CUR_RATING, METRICS
     CUR_RATING = rating
     ratings_dict = cfg["NUM_EXPECTED_GAMES"]["RATINGS"]
 
-    out_path = os.path.join(cfg["PGN_DIR"], cfg["BY_ELO_DIR"], str(rating)+cfg["PGN_EXT"])
+    if out_path is None:
+        out_path = os.path.join(cfg["PGN_DIR"], cfg["BY_ELO_DIR"], str(rating)+cfg["PGN_EXT"])
     cnt = 0
     cnt_total = 0
     batch = []
-    with open(PGN_PATH, 'r') as pgn_file, open(out_path, 'w') as out_file:
+    # Clock records follow their games, re-keyed by the offsets in out_path.
+    clock_reader = clock_sidecar.open_clock_reader(pgn_path) if keep_clocks else None
+    clock_writer = clock_sidecar.ClockWriter(clock_sidecar.build_clock_path(out_path)) if clock_reader else None
+    out_offset = 0
+    in_offset = None    # Of the next game, once known: tell() only for a kept game after skipped ones.
+    with open_pgn(pgn_path) as pgn_file, open(out_path, 'w') as out_file:
+        METRICS = metrics.start_metrics("separate_by_elo", pgn_file, rating=rating, out_path=out_path)
         while True:
             FIRST_PLAYER_VALID = False
             try:
@@ -63,12 +77,23 @@ def separate_by_elo(rating):
                 break
 
             cnt_total += 1
+            METRICS.tick(cnt_total, cnt)
             if headers == "":   # Game was skipped.
+                in_offset = None
                 continue
 
             # Record the game.
+            if clock_reader is not None and in_offset is None:
+                in_offset = clock_sidecar.header_offset(pgn_file, headers)
             game = "\n".join((headers, read_game(pgn_file), ""))
             batch.append(game)
+            if clock_reader is not None:
+                clocks = clock_reader.get(in_offset)
+                if clocks is not None:
+                    clock_writer.write(out_offset, clocks)
+                game_size = len(game.encode())  # Same layout as the input game.
+                in_offset += game_size
+                out_offset += game_size
             if len(batch) >= cfg["BATCH_SIZE"]:
                 cnt += cfg["BATCH_SIZE"]
                 out_file.write("".join(batch))
@@ -77,8 +102,13 @@ def separate_by_elo(rating):
             cnt += len(batch)
             out_file.write("".join(batch))
 
+    if clock_reader is not None:
+        clock_reader.close()
+        clock_writer.close()
+    METRICS.count("bytes_written", os.path.getsize(out_path))
+    METRICS.finish(cnt_total, cnt)
     print(cli_util.success(f"Wrote {cnt} games to {out_path} (out of {cnt_total})."))
-    return
+    return cnt, cnt_total
 
 
 if __name__ == "__main__":
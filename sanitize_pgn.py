@@ -1,10 +1,18 @@
 import json
 import os
 import re
+import sys
 
 import cli_util
+import dedup
+import metrics
+import checkpoint
+import clock_sidecar
+from profiling import profiled
+from prefetch_reader import open_pgn
 
-from parse_pgn import read_headers, skip_game
+from parse_pgn import read_headers, parse_headers, skip_game
+from eco_groupby import HeaderGroups, build_groups_path
 
 ### CONFIG
 try:
@@ -18,6 +26,9 @@ DEBUG_MODE = cfg["DEBUG_MODE"]
 EXTRA_DEBUG_MODE = cfg["EXTRA_DEBUG_MODE"]
 PGN_TO_USE = "SAMPLE2"
 MODE_TO_USE = "ALL" #MASTERS or ALL
+DEDUP_CFG = cfg["DEDUP"]
+GROUP_CFG = cfg["GROUP_BY"]
+CLOCK_CFG = cfg["CLOCKS"]
 
 HEADERS_TO_REMOVE = {"UTCDate", "UTCTime", "WhiteRatingDiff", "BlackRatingDiff", "Termination",
     "White", "Black", "WhiteTitle", "BlackTitle", "Date", "Round", "Event", "LichessURL", "Site"}
@@ -26,18 +37,22 @@ SANITIZE_REGEX = re.compile(" \{.+?\}| \$\d+| \d+\.\.\.|[?!]")
 # Merged valid time-controls for blitz, rapid, and classical.
 TC_BRC = set(sum([cfg["TC"][tc] for tc in ["BLITZ", "RAPID", "CLASSICAL"]], []))
 
+METRICS = metrics.NULL_METRICS
+
 
 def is_valid_tc(name, value):
     if name == cfg["PGN_HEADERS"]["TIME"]:
         if value not in TC_BRC:
-            if DEBUG_MODE:
+            METRICS.skip("invalid_tc")
+            if EXTRA_DEBUG_MODE:
                 print(cli_util.info(f"Invalid TC: {value}. Skipping game..."))
             return -1
         return 1
     return 0
 
 
-def read_game_unsanitized(pgn_file, mode):
+def read_game_unsanitized(pgn_file, mode, clocks=None):
+    # If clocks is a list, the game's %clk times (seconds) are appended to it before stripping.
     lines = []
     while True:
         line = pgn_file.readline()
@@ -51,32 +66,114 @@ def read_game_unsanitized(pgn_file, mode):
             lines.append(line.strip("\n"))
             lines.append(" ")
         else:
+            if clocks is not None:
+                clocks.extend(clock_sidecar.parse_clocks(line))
             # Remove clock/eval data.
             lines.append(re.sub(SANITIZE_REGEX, '', line))
 
 
-def sanitize_games(pgn_file):
+def build_sanitized_path(pgn_to_use=PGN_TO_USE):
+    src_filename = os.path.splitext(cfg["PGN_FILENAME_SRC"][pgn_to_use])[0]
+    return (cfg["PGN_DIR"] + cfg["SANITIZED_DIR"] + src_filename +
+        cfg["SANITIZED_SUFFIX"] + cfg["PGN_EXT"])
+
+
+@profiled
+def sanitize_games(pgn_file, out_path=None, mode=MODE_TO_USE, num_expected=None, resume=False,
+        remove_duplicates=DEDUP_CFG["ENABLED"], group_by=GROUP_CFG["ENABLED"], keep_clocks=CLOCK_CFG["ENABLED"]):
+    global METRICS
     batch = []
     num_keep = 0
     num_games = 0
-
-    src_filename = os.path.splitext(cfg["PGN_FILENAME_SRC"][PGN_TO_USE])[0]
-    out_path = (cfg["PGN_DIR"] + cfg["SANITIZED_DIR"] + src_filename +
-        cfg["SANITIZED_SUFFIX"] + cfg["PGN_EXT"])
-    with open(out_path, 'w') as out_file:
+    num_dupes = 0
+
+    if out_path is None:
+        out_path = build_sanitized_path()
+    METRICS = metrics.start_metrics("sanitize_games", pgn_file, num_expected, out_path=out_path, mode=mode)
+
+    ckpt_path = checkpoint.build_checkpoint_path(out_path)
+    state = checkpoint.load_checkpoint(ckpt_path, pgn_file.name) if resume else None
+    if state is not None:
+        pgn_file.seek(state["in_offset"])
+        os.truncate(out_path, state["out_offset"])
+        num_keep, num_games = state["num_keep"], state["num_read"]
+        num_dupes = state.get("num_dupes", 0)
+        METRICS.restore(state["metrics"])
+
+    seen = None
+    bloom_path = None
+    if remove_duplicates:
+        # The filter is saved with each checkpoint (under a new name, so it can't get ahead of it).
+        bloom_path = state.get("bloom") if state is not None else None
+        seen = dedup.open_filter(os.path.basename(pgn_file.name), resume_path=bloom_path)
+    groups = None
+    if group_by:
+        groups = HeaderGroups.from_state(state["groups"]) if state and state.get("groups") else HeaderGroups()
+    clock_writer = None
+    if keep_clocks and mode != "MASTERS":
+        clock_writer = clock_sidecar.ClockWriter(clock_sidecar.build_clock_path(out_path),
+            state.get("clk_offset") if state is not None else None)
+    next_ckpt = num_games + checkpoint.CHECKPOINT_EVERY
+
+    with open(out_path, 'a' if state is not None else 'w') as out_file:
+        next_offset = out_file.tell()   # Byte offset of the next kept game, for the clock sidecar.
         while True:
+            if num_games >= next_ckpt:
+                # At a game boundary: flush so the output matches the input offset.
+                num_keep += len(batch)
+                out_file.write("".join(batch))
+                batch = []
+                out_file.flush()
+                prev_bloom_path = bloom_path
+                if seen is not None:
+                    bloom_path = f"{ckpt_path}.{num_games}{DEDUP_CFG['SUFFIX']}"
+                    seen.save(bloom_path)
+                checkpoint.save_checkpoint(ckpt_path, {
+                    "input": checkpoint.fingerprint(pgn_file.name),
+                    "in_offset": pgn_file.tell(),
+                    "out_offset": out_file.tell(),
+                    "num_keep": num_keep,
+                    "num_read": num_games,
+                    "num_dupes": num_dupes,
+                    "bloom": bloom_path,
+                    "groups": groups.state() if groups is not None else None,
+                    "clk_offset": clock_writer.tell() if clock_writer is not None else None,
+                    "metrics": METRICS.state(),
+                })
+                if prev_bloom_path is not None:
+                    os.remove(prev_bloom_path)
+                next_ckpt += checkpoint.CHECKPOINT_EVERY
+
+            removed = {} if seen is not None else None
             try:
-                headers = read_headers(pgn_file, is_valid_tc, HEADERS_TO_REMOVE)
+                headers = read_headers(pgn_file, is_valid_tc, HEADERS_TO_REMOVE, removed)
             except EOFError:
                 break
 
             num_games += 1
+            METRICS.tick(num_games, num_keep)
             if headers == "":   # Game was skipped.
                 continue
 
+            clocks = [] if clock_writer is not None else None
+            movetext = read_game_unsanitized(pgn_file, mode, clocks)
+            if seen is not None and seen.add(dedup.game_key(removed, headers, movetext)):
+                num_dupes += 1
+                METRICS.skip("duplicate")
+                continue
+            if groups is not None:
+                parsed = parse_headers(headers)
+                result = parsed.get(cfg["PGN_HEADERS"]["RESULT"])
+                if result in cfg["RESULTS"]:
+                    groups.add(parsed, cfg["RESULTS"][result])
+
             # Record the game.
-            game = "\n".join((headers, read_game_unsanitized(pgn_file, MODE_TO_USE), ""))
+            game = "\n".join((headers, movetext, ""))
             batch.append(game)
+            if clock_writer is not None:
+                if clocks:
+                    clock_writer.write(next_offset, clocks)
+                next_offset += len(game.encode())
 
             if len(batch) >= cfg["BATCH_SIZE"]:
                 num_keep += cfg["BATCH_SIZE"]
@@ -87,9 +184,23 @@ def sanitize_games(pgn_file):
             num_keep += len(batch)
             out_file.write("".join(batch))
 
+    if clock_writer is not None:
+        METRICS.count("clock_bytes", clock_writer.tell())
+        clock_writer.close()
+    if seen is not None:
+        dedup.save_filter(seen)
+        if bloom_path is not None:
+            os.remove(bloom_path)
+        print(cli_util.info(f"Removed {num_dupes} duplicate games."))
+    if groups is not None:
+        groups.write(build_groups_path(os.path.splitext(os.path.basename(out_path))[0]))
+    checkpoint.clear_checkpoint(ckpt_path)
+    METRICS.count("bytes_written", os.path.getsize(out_path))
+    METRICS.finish(num_games, num_keep)
     print(cli_util.success(f"Retained and sanitized {num_keep} out of {num_games} games."))
-
+    return num_keep, num_games
 
 if __name__ == "__main__":
-    with open(cfg['PGN_DIR'] + cfg['SRC_DIR'] + cfg['PGN_FILENAME_SRC'][PGN_TO_USE], 'r') as f:
-        sanitize_games(f)
+    with open_pgn(cfg['PGN_DIR'] + cfg['SRC_DIR'] + cfg['PGN_FILENAME_SRC'][PGN_TO_USE]) as f:
+        sanitize_games(f, num_expected=cfg["NUM_EXPECTED_GAMES"].get(PGN_TO_USE),
+            resume="--resume" in sys.argv)